@@ -1,77 +1,225 @@
 from multiprocessing import connection, Pipe
-from threading import Thread
+from threading import Thread, Condition, Lock
+from collections import OrderedDict
 
 import os
+import sys
 import numpy as np
 import shutil
 
 from cchess_alphazero.config import Config
+from cchess_alphazero.environment.lookup_tables import Mirrored_index
 from cchess_alphazero.lib.model_helper import load_best_model_weight, need_to_reload_best_model_weight
 from cchess_alphazero.lib.web_helper import http_request, download_file
 from time import time
 from logging import getLogger
 
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:     # Python < 3.8
+    shared_memory = resource_tracker = None
+
 logger = getLogger(__name__)
 
 class CChessModelAPI:
 
     def __init__(self, config: Config, agent_model):  
+        if config.play.shared_memory_transport and shared_memory is None:
+            raise RuntimeError("shared_memory_transport needs multiprocessing.shared_memory (Python 3.8+), "
+                               "set it to False")
         self.agent_model = agent_model  # CChessModel
         self.pipes = []     # use for communication between processes/threads
         self.config = config
         self.need_reload = True
         self.done = False
+        self.channels = {}  # pipe -> (shared memory, planes, policy, value) if shared_memory_transport
+        self.max_batch_size = config.play.batch_max_size
+        self.max_wait = config.play.batch_max_wait_us / 1e6
+        self.adaptive = config.play.batch_adaptive_wait
+        self.arrival_gap = self.max_wait    # moving average of the time between two requests
+        self.last_arrival = 0
+        self.n_batches = 0
+        self.n_states = 0
+        self.total_delay = 0    # queueing delay of all states
+        self.held = None        # request which did not fit into the last batch, the first of the next one
+        cache_size = config.play.eval_cache_size
+        if config.play.eval_cache_mb:
+            cache_size = int(config.play.eval_cache_mb * 2 ** 20) // EvalCache.entry_bytes(agent_model.n_labels)
+        self.cache = EvalCache(cache_size, agent_model.digest, config.play.eval_cache_mirror)
 
     def start(self, need_reload=True):
         self.need_reload = need_reload
-        prediction_worker = Thread(target=self.predict_batch_worker, name="prediction_worker")
-        prediction_worker.daemon = True
-        prediction_worker.start()
+        self.prediction_worker = Thread(target=self.predict_batch_worker, name="prediction_worker")
+        self.prediction_worker.daemon = True
+        self.prediction_worker.start()
 
     def get_pipe(self, need_reload=True):
         me, you = Pipe()
         self.pipes.append(me)
         self.need_reload = need_reload
+        if self.config.play.shared_memory_transport:
+            slots = 2 * self.config.play.search_threads * self.config.play.games_per_process
+            plane_shape = tuple(self.agent_model.model.input_shape[1:])
+            n_labels = self.agent_model.n_labels
+            shm = shared_memory.SharedMemory(create=True, size=shm_size(slots, plane_shape, n_labels))
+            self.channels[me] = (shm,) + shm_arrays(shm, slots, plane_shape, n_labels)
+            return ShmPipe(you, shm.name, slots, plane_shape, n_labels, tracker_id())
         return you
 
     def predict_batch_worker(self):
+        try:
+            self.serve_batches()
+        finally:
+            # the API created the shared memory blocks, it is the only one to unlink them
+            for shm, _, _, _ in self.channels.values():
+                shm.close()
+                shm.unlink()
+            self.channels = {}
+
+    def serve_batches(self):
         if self.config.internet.distributed and self.need_reload:
             self.try_reload_model_from_internet()
         last_model_check_time = time()
         while not self.done:
-            if last_model_check_time + 600 < time() and self.need_reload:
-                self.try_reload_model()
+            if last_model_check_time + 600 < time():
+                if self.need_reload:
+                    self.try_reload_model()
+                self.log_batch_stats()
                 last_model_check_time = time()
-            ready = connection.wait(self.pipes, timeout=0.001)
-            if not ready:
-                continue
-            data, result_pipes, data_len = [], [], []
-            for pipe in ready:
-                while pipe.poll():
-                    try:
-                        tmp = pipe.recv()
-                    except EOFError as e:
-                        logger.error(f"EOF error: {e}")
-                        pipe.close()
-                    else:
-                        data.extend(tmp)
-                        data_len.append(len(tmp))
-                        result_pipes.append(pipe)
+            data, result_pipes, data_len, arrivals = [], [], [], []
+            if self.held is not None:
+                self.take(self.held, data, result_pipes, data_len, arrivals)
+                self.held = None
+            else:
+                ready = connection.wait(self.pipes, timeout=0.001)
+                if not ready:
+                    continue
+                self.receive(ready, data, result_pipes, data_len, arrivals)
+            first_arrival = arrivals[0] if arrivals else time()
+            while self.max_wait > 0 and self.held is None and \
+                  (not self.max_batch_size or sum(data_len) < self.max_batch_size):
+                wait = first_arrival + self.max_wait - time()
+                if self.adaptive:
+                    wait = min(wait, 2 * self.arrival_gap)
+                if wait <= 0:
+                    break
+                ready = connection.wait(self.pipes, timeout=wait)
+                if not ready:
+                    break
+                self.receive(ready, data, result_pipes, data_len, arrivals)
             if not data:
                 continue
-            data = np.asarray(data, dtype=np.float32)
-            with self.agent_model.graph.as_default():
-                policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
-            buf = []
-            k, i = 0, 0
-            for p, v in zip(policy_ary, value_ary):
-                buf.append((p, float(v)))
-                k += 1
-                if k >= data_len[i]:
-                    result_pipes[i].send(buf)
-                    buf = []
-                    k = 0
-                    i += 1
+            now = time()
+            n_states = sum(data_len)
+            self.n_batches += -(-n_states // self.max_batch_size) if self.max_batch_size else 1
+            self.n_states += n_states
+            self.total_delay += sum((now - t) * n for t, n in zip(arrivals, data_len))
+            data = data[0] if len(data) == 1 else np.concatenate(data)
+            policy_ary, value_ary = self.predict(data)
+            k = 0
+            for (pipe, tmp), n in zip(result_pipes, data_len):
+                if pipe in self.channels:
+                    start = tmp[0]
+                    _, _, policy, value = self.channels[pipe]
+                    policy[start:start + n] = policy_ary[k:k + n]
+                    value[start:start + n] = value_ary[k:k + n]
+                    pipe.send(tmp)
+                else:
+                    pipe.send([(p, float(v)) for p, v in zip(policy_ary[k:k + n], value_ary[k:k + n])])
+                k += n
+
+    def predict(self, data):
+        '''
+        Run the model on the states of data which are not in the evaluation cache
+        '''
+        if not self.cache.size:
+            policy_ary, value_ary = self.predict_on_model(data)
+            return policy_ary, value_ary.reshape(-1)
+        keys = [self.cache.key(x) for x in data]
+        policy_ary = np.empty((len(data), self.agent_model.n_labels), dtype=np.float32)
+        value_ary = np.empty(len(data), dtype=np.float32)
+        miss = []
+        for i, key in enumerate(keys):
+            ret = self.cache.get(*key)
+            if ret is None:
+                miss.append(i)
+            else:
+                policy_ary[i], value_ary[i] = ret
+        if miss:
+            policy, value = self.predict_on_model(data[miss])
+            policy_ary[miss] = policy
+            value_ary[miss] = value.reshape(-1)
+            for i in miss:
+                self.cache.put(*keys[i], policy_ary[i].copy(), value_ary[i])
+        return policy_ary, value_ary
+
+    def predict_on_model(self, data):
+        '''
+        Run the model in pieces of at most `max_batch_size` states (a single request may be larger)
+        '''
+        step = self.max_batch_size or len(data)
+        policies, values = [], []
+        with self.agent_model.graph.as_default():
+            for i in range(0, len(data), step):
+                policy, value = self.agent_model.model.predict_on_batch(data[i:i + step])
+                policies.append(policy)
+                values.append(value)
+        if len(policies) == 1:
+            return policies[0], values[0]
+        return np.concatenate(policies), np.concatenate(values)
+
+    def receive(self, ready, data, result_pipes, data_len, arrivals):
+        '''
+        Read the requests of the ready pipes until the batch is full, a request which would
+        make the batch larger than `max_batch_size` is held over for the next batch
+        '''
+        for pipe in ready:
+            while pipe.poll():
+                if self.max_batch_size and sum(data_len) >= self.max_batch_size:
+                    return
+                try:
+                    tmp = pipe.recv()
+                except EOFError as e:
+                    logger.error(f"EOF error: {e}")
+                    pipe.close()
+                    self.pipes.remove(pipe)
+                    break
+                now = time()
+                if self.last_arrival:
+                    self.arrival_gap = 0.9 * self.arrival_gap + 0.1 * (now - self.last_arrival)
+                self.last_arrival = now
+                if pipe in self.channels:
+                    # (start, n): planes are already in the shared memory
+                    start, n = tmp
+                    planes = self.channels[pipe][1][start:start + n]
+                else:
+                    planes = np.asarray(tmp, dtype=np.float32)
+                request = (pipe, tmp, planes, now)
+                if data_len and self.max_batch_size and sum(data_len) + len(planes) > self.max_batch_size:
+                    self.held = request
+                    return
+                self.take(request, data, result_pipes, data_len, arrivals)
+
+    def take(self, request, data, result_pipes, data_len, arrivals):
+        pipe, tmp, planes, arrival = request
+        data.append(planes)
+        data_len.append(len(planes))
+        result_pipes.append((pipe, tmp))
+        arrivals.append(arrival)
+
+    def batch_stats(self):
+        '''
+        Return (number of batches, mean batch size, mean queueing delay in ms)
+        '''
+        if not self.n_batches:
+            return 0, 0, 0
+        return self.n_batches, self.n_states / self.n_batches, self.total_delay / self.n_states * 1000
+
+    def log_batch_stats(self):
+        n_batches, size, delay = self.batch_stats()
+        logger.debug(f"Predict {n_batches} batches, mean size = {size:.1f}, mean queueing delay = {delay:.2f} ms")
+        if self.cache.size:
+            logger.debug(f"Evaluation cache: {len(self.cache.entries)} entries, hit rate = {self.cache.hit_rate():.3f}")
 
     def try_reload_model(self, config_file=None):
         if config_file:
@@ -84,6 +232,7 @@ class CChessModelAPI:
                 if self.need_reload and need_to_reload_best_model_weight(self.agent_model):
                     with self.agent_model.graph.as_default():
                         load_best_model_weight(self.agent_model)
+                    self.cache.reset(self.agent_model.digest)
         except Exception as e:
             logger.error(e)
 
@@ -101,6 +250,7 @@ class CChessModelAPI:
                 try:
                     with self.agent_model.graph.as_default():
                         load_best_model_weight(self.agent_model)
+                    self.cache.reset(self.agent_model.digest)
                 except ValueError as e:
                     logger.error(f"权重架构不匹配，自动重新加载 {e}")
                     self.try_reload_model(config_file='model_192x10_config.json')
@@ -115,3 +265,221 @@ class CChessModelAPI:
 
     def close(self):
         self.done = True
+        worker = getattr(self, 'prediction_worker', None)
+        if worker is not None and worker.is_alive():
+            worker.join(timeout=1)
+
+
+class EvalCache:
+    '''
+    LRU cache of (policy, value) in front of the model, keyed by model digest and a hash of the input planes.
+    With `mirror`, a state and its left-right mirror share one entry stored for the canonical
+    (smaller hash) side
+    '''
+    def __init__(self, size, digest=None, mirror=False):
+        self.size = size
+        self.digest = digest
+        self.mirror = mirror
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_bytes(n_labels):
+        return n_labels * 4 + 200   # policy + value, key and dict overhead
+
+    def key(self, planes):
+        '''
+        Return (key, whether the entry is stored for the mirrored state)
+        '''
+        h = hash(planes.tobytes())
+        if self.mirror:
+            h_mirror = hash(np.ascontiguousarray(planes[..., ::-1]).tobytes())
+            if h_mirror < h:
+                return (self.digest, h_mirror), True
+        return (self.digest, h), False
+
+    def get(self, key, mirrored):
+        ret = self.entries.get(key)
+        if ret is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        if mirrored:
+            return ret[0][Mirrored_index], ret[1]
+        return ret
+
+    def put(self, key, mirrored, policy, value):
+        if mirrored:
+            policy = policy[Mirrored_index]
+        self.entries[key] = (policy, value)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def reset(self, digest):
+        '''
+        Drop all entries, called when new weights are loaded
+        '''
+        self.entries.clear()
+        self.digest = digest
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+def shm_size(slots, plane_shape, n_labels):
+    return slots * (int(np.prod(plane_shape)) + n_labels + 1) * 4
+
+def tracker_id():
+    '''
+    Identity of the resource tracker of this process: the inode of the pipe to it, which is
+    the same in the children sharing the tracker of their parent
+    '''
+    if os.name != 'posix':
+        return None
+    return os.fstat(resource_tracker.getfd()).st_ino
+
+def shm_arrays(shm, slots, plane_shape, n_labels):
+    '''
+    Views of a shared memory block: input planes, output policy and value of each slot
+    '''
+    n_planes = slots * int(np.prod(plane_shape))
+    planes = np.ndarray((slots,) + plane_shape, dtype=np.float32, buffer=shm.buf)
+    policy = np.ndarray((slots, n_labels), dtype=np.float32, buffer=shm.buf, offset=n_planes * 4)
+    value = np.ndarray((slots,), dtype=np.float32, buffer=shm.buf, offset=(n_planes + slots * n_labels) * 4)
+    return planes, policy, value
+
+class ShmPipe:
+    '''
+    Player side of a pipe to CChessModelAPI which passes planes and results through shared memory.
+    The block is a ring of fixed-size slots, a request is written once into consecutive slots
+    and only (start, n) goes through the underlying pipe
+    '''
+    def __init__(self, pipe, name, slots, plane_shape, n_labels, tracker=None):
+        self.pipe = pipe
+        self.name = name
+        self.slots = slots
+        self.plane_shape = plane_shape
+        self.n_labels = n_labels
+        self.tracker = tracker      # resource tracker of the creator, which owns the block
+        self.attach()
+
+    def attach(self):
+        if sys.version_info >= (3, 13):
+            self.shm = shared_memory.SharedMemory(name=self.name, track=False)
+        else:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+            if os.name == 'posix' and tracker_id() != self.tracker:
+                # attaching registered the block with the tracker of this process, which would
+                # unlink it (and warn about a leak) when this process exits
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.planes, self.policy, self.value = shm_arrays(self.shm, self.slots, self.plane_shape, self.n_labels)
+        self.head = 0
+
+    def __getstate__(self):
+        return (self.pipe, self.name, self.slots, self.plane_shape, self.n_labels, self.tracker)
+
+    def __setstate__(self, state):
+        self.pipe, self.name, self.slots, self.plane_shape, self.n_labels, self.tracker = state
+        self.attach()
+
+    def send(self, data):
+        n = len(data)
+        if n > self.slots:
+            raise ValueError(f"Request of {n} states exceeds the {self.slots} shared memory slots")
+        start = self.head if self.head + n <= self.slots else 0
+        for i, planes in enumerate(data):
+            self.planes[start + i] = planes
+        self.head = start + n
+        self.pipe.send((start, n))
+
+    def poll(self, timeout=0):
+        return self.pipe.poll(timeout)
+
+    def recv(self):
+        start, n = self.pipe.recv()
+        return [(self.policy[i].copy(), float(self.value[i])) for i in range(start, start + n)]
+
+    def close(self):
+        self.pipe.close()
+        self.shm.close()
+
+class SharedPipe:
+    '''
+    One pipe to CChessModelAPI shared by several players of the same process (one per thread).
+    Requests of all players are merged into a single batch which is sent when every player
+    is waiting, or after `max_wait` seconds. A player leaving (its game thread ends) detaches
+    its client so the others do not wait for it
+    '''
+    def __init__(self, pipe, num_players, max_wait=0.01):
+        self.pipe = pipe
+        self.num_players = num_players
+        self.max_wait = max_wait
+        self.cond = Condition()
+        self.io_lock = Lock()
+        self.requests = []      # (client, data)
+
+    def get_pipe(self):
+        return SharedPipeClient(self)
+
+    def flush(self):
+        '''
+        Send the pending requests as one batch, must be called with `cond` acquired
+        '''
+        batch, self.requests = self.requests, []
+        self.cond.release()
+        try:
+            with self.io_lock:
+                self.pipe.send([x for _, data in batch for x in data])
+                rets = self.pipe.recv()
+        finally:
+            self.cond.acquire()
+        i = 0
+        for client, data in batch:
+            client.result = rets[i:i + len(data)]
+            i += len(data)
+        self.cond.notify_all()
+
+class SharedPipeClient:
+    '''
+    Pipe-like endpoint of a SharedPipe, only supports a send() followed by a recv()
+    '''
+    def __init__(self, shared):
+        self.shared = shared
+        self.result = None
+        self.detached = False
+
+    def send(self, data):
+        with self.shared.cond:
+            self.result = None
+            self.shared.requests.append((self, data))
+            if len(self.shared.requests) >= self.shared.num_players:
+                self.shared.flush()
+            else:
+                self.shared.cond.notify_all()
+
+    def recv(self):
+        shared = self.shared
+        with shared.cond:
+            start = time()
+            while self.result is None:
+                if any(client is self for client, _ in shared.requests) and \
+                    (len(shared.requests) >= shared.num_players or time() - start >= shared.max_wait):
+                    shared.flush()
+                else:
+                    shared.cond.wait(shared.max_wait)
+            result, self.result = self.result, None
+            return result
+
+    def detach(self):
+        '''
+        Stop counting this player in the batch of the SharedPipe
+        '''
+        with self.shared.cond:
+            if self.detached:
+                return
+            self.detached = True
+            self.shared.num_players -= 1
+            # the waiting players may fill the batch now
+            self.shared.cond.notify_all()
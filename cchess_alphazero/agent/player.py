@@ -7,7 +7,7 @@ import concurrent.futures.thread
 import numpy as np
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.config import Config
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, Move_2_Idx, flip_move
 from time import time, sleep
 import gc 
 import sys
@@ -15,22 +15,77 @@ import sys
 logger = getLogger(__name__)
 
 class VisitState:
+    __slots__ = ('sum_n', 'visit', 'p', 'legal_moves', 'labels', 'waiting', 'noise', 'terminal',
+                 'a_n', 'a_w', 'a_q', 'a_p')
+
     def __init__(self):
-        self.a = defaultdict(ActionState)   # key: action, value: ActionState
         self.sum_n = 0                      # visit count
-        self.visit = []                     # thread id that has visited this state
+        self.visit = None                   # (position, history) of searches waiting for NN's predict
         self.p = None                       # policy of this state
         self.legal_moves = None             # all leagal moves of this state
+        self.labels = None                  # ActionLabelsRed index of each legal move
         self.waiting = False                # is waiting for NN's predict
-        self.w = 0
-
-
-class ActionState:
-    def __init__(self):
-        self.n = 0      # N(s, a) : visit count
-        self.w = 0      # W(s, a) : total action value
-        self.q = 0      # Q(s, a) = N / W : action value
-        self.p = 0      # P(s, a) : prior probability
+        self.noise = None                   # dirichlet noise of the root, sampled once per search
+        self.terminal = 0                   # value of the finished game at this state, 0 if it goes on
+        # statistics of the edges, one entry per legal move
+        self.a_n = None                     # N(s, a) : visit count
+        self.a_w = None                     # W(s, a) : total action value
+        self.a_q = None                     # Q(s, a) = W / N : action value
+        self.a_p = None                     # P(s, a) : prior probability
+
+    def expand(self, legal_moves, labels):
+        self.legal_moves = tuple(legal_moves)
+        self.labels = labels
+        k = len(legal_moves)
+        self.a_n = np.zeros(k)
+        self.a_w = np.zeros(k)
+        self.a_q = np.zeros(k)
+        self.a_p = np.zeros(k)
+
+
+class SearchTree(dict):
+    '''
+    Node store of the search: state key -> VisitState, nodes are created on first access
+    (like a defaultdict) and `max_nodes` bounds its size: before a search the tree is pruned to
+    the subtree of the root (or cleared) to make room for one node per simulation (a quarter
+    of the budget for an infinite search), and a search stops early when the tree is full
+    (after the current batch of `search_threads`)
+    '''
+    def __init__(self, max_nodes=None):
+        super().__init__()
+        self.max_nodes = max_nodes
+
+    def __missing__(self, key):
+        node = self[key] = VisitState()
+        return node
+
+    def over_budget(self, new_nodes=0):
+        return self.max_nodes is not None and len(self) + new_nodes > self.max_nodes
+
+    def prune(self, pos):
+        '''
+        Keep only the nodes reachable from `pos` (a senv.Position at the new root) through
+        visited edges, return the number of visits carried over to the new root
+        '''
+        root = pos.key
+        keep = set()
+        if root in self:
+            keep.add(root)
+            stack = [pos]
+            while stack:
+                pos = stack.pop()
+                node = dict.__getitem__(self, pos.key)
+                if node.a_n is None:
+                    continue
+                for i in np.flatnonzero(node.a_n > 0):
+                    child = pos.copy()
+                    child.make_move(node.legal_moves[i])
+                    if child.key in self and child.key not in keep:
+                        keep.add(child.key)
+                        stack.append(child)
+        for key in [key for key in self if key not in keep]:
+            del self[key]
+        return self[root].sum_n if root in self else 0
 
 class CChessPlayer:
     def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None, 
@@ -39,14 +94,14 @@ class CChessPlayer:
         self.play_config = play_config or self.config.play
         self.labels_n = len(ActionLabelsRed)
         self.labels = ActionLabelsRed
-        self.move_lookup = {move: i for move, i in zip(self.labels, range(self.labels_n))}
+        self.move_lookup = Move_2_Idx
         self.pipe = pipes                   # pipes that used to communicate with CChessModelAPI thread
-        self.node_lock = defaultdict(Lock)  # key: state key, value: Lock of that state
+        self.node_lock = defaultdict(Lock)  # key: state key (zobrist hash), value: Lock of that state
         self.use_history = use_history
         self.increase_temp = False
 
         if search_tree is None:
-            self.tree = defaultdict(VisitState)  # key: state key, value: VisitState
+            self.tree = SearchTree(self.play_config.max_tree_nodes)  # key: state key (zobrist hash), value: VisitState
         else:
             self.tree = search_tree
 
@@ -56,7 +111,7 @@ class CChessPlayer:
         self.debugging = debugging
 
         self.search_results = {}        # for debug
-        self.debug = {}
+        self.debug = {}                 # key: state key, value: (policy, value) of NN
         self.side = side
 
         self.s_lock = Lock()
@@ -74,9 +129,13 @@ class CChessPlayer:
 
         self.job_done = False
 
-        self.executor = ThreadPoolExecutor(max_workers=self.play_config.search_threads + 2)
-        self.executor.submit(self.receiver)
-        self.executor.submit(self.sender)
+        self.batched = self.play_config.batched_search
+        if self.batched:
+            self.executor = None
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.play_config.search_threads + 2)
+            self.executor.submit(self.receiver)
+            self.executor.submit(self.sender)
 
     def close(self, wait=True):
         self.job_done = True
@@ -85,6 +144,22 @@ class CChessPlayer:
         if self.executor is not None:
             self.executor.shutdown(wait=wait)
 
+    def advance_root(self, state, action=None):
+        '''
+        Move the root of the search tree to `state` (or to the state after `action` is played
+        in `state`), free every node that is not reachable any more and return the number of
+        visits carried over to the new root
+        '''
+        pos = senv.Position(state)
+        if action is not None:
+            pos.make_move(action)
+        n = len(self.tree)
+        carried = self.tree.prune(pos)
+        for key in [key for key in self.node_lock if key not in self.tree]:
+            del self.node_lock[key]
+        logger.debug(f"Advance root: keep {len(self.tree)}/{n} nodes, carry over {carried} visits")
+        return carried
+
     def close_and_return_action(self, state, turns, no_act=None):
         self.job_done = True
         if self.executor is not None:
@@ -99,8 +174,9 @@ class CChessPlayer:
             for act in no_act:
                 policy[self.move_lookup[act]] = 0
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
-        if state in self.debug:
-            _, value = self.debug[state]
+        key = senv.state_key(state)
+        if key in self.debug:
+            _, value = self.debug[key]
         else:
             value = 0
         return self.labels[my_action], value, self.done_tasks // 100
@@ -144,14 +220,28 @@ class CChessPlayer:
 
     def action(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False) -> str:
         self.all_done.acquire(True)
-        self.root_state = state
+        key = senv.state_key(state)
+        self.root_state = key
+        if isinstance(self.tree, SearchTree):
+            # each simulation expands at most one node, an infinite search gets a quarter of the budget
+            if infinite:
+                new_nodes = self.tree.max_nodes // 4 if self.tree.max_nodes else 0
+            else:
+                new_nodes = depth or self.play_config.simulation_num_per_move
+            if infinite or self.tree.over_budget(new_nodes):
+                self.advance_root(state)
+            if self.tree.over_budget(new_nodes):
+                logger.debug(f"Search tree has {len(self.tree)} nodes, no room for {new_nodes} more, reset it")
+                self.tree.clear()
+                self.node_lock.clear()
         self.no_act = no_act
         self.increase_temp = increase_temp
         if hist and len(hist) >= 5:
             hist = hist[-5:]
         done = 0
-        if state in self.tree:
-            done = self.tree[state].sum_n
+        if key in self.tree:
+            done = self.tree[key].sum_n
+            self.tree[key].noise = None
         if no_act or increase_temp or done == self.play_config.simulation_num_per_move:
             # logger.info(f"no_act = {no_act}, increase_temp = {increase_temp}")
             done = 0
@@ -164,7 +254,9 @@ class CChessPlayer:
         depth = 0
         start_time = time()
         # MCTS search
-        if self.num_task > 0:
+        if self.num_task > 0 and self.batched:
+            self.batch_search(state, turns, hist, start_time)
+        elif self.num_task > 0:
             all_tasks = self.num_task
             batch = all_tasks // self.config.play.search_threads
             if all_tasks % self.config.play.search_threads != 0:
@@ -175,13 +267,15 @@ class CChessPlayer:
                 self.done_tasks += self.num_task
                 # logger.debug(f"iter = {iter}, num_task = {self.num_task}")
                 for i in range(self.num_task):
-                    self.executor.submit(self.MCTS_search, state, [state], True, hist)
+                    self.executor.submit(self.MCTS_search, senv.Position(state), [key], True, hist)
                 self.all_done.acquire(True)
                 if self.uci and depth != self.done_tasks // 100:
                     # info depth xx pv xxx
                     depth = self.done_tasks // 100
-                    _, value = self.debug[state]
+                    _, value = self.debug[key]
                     self.print_depth_info(state, turns, start_time, value, no_act)
+                if self.tree_full():
+                    break
         self.all_done.release()
 
         policy, resign = self.calc_policy(state, turns, no_act)
@@ -195,91 +289,209 @@ class CChessPlayer:
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
         return self.labels[my_action], list(policy)
 
-    def MCTS_search(self, state, history=[], is_root_node=False, real_hist=None) -> float:
+    def tree_full(self):
+        if isinstance(self.tree, SearchTree) and self.tree.over_budget(1):
+            logger.debug(f"Search tree is full with {len(self.tree)} nodes, stop the search")
+            return True
+        return False
+
+    def MCTS_search(self, pos, history=[], is_root_node=False, real_hist=None) -> float:
         """
-        Monte Carlo Tree Search
+        Monte Carlo Tree Search, `pos` is a senv.Position and `history` holds state keys and actions
         """
         while True:
-            # logger.debug(f"start MCTS, state = {state}, history = {history}")
-            game_over, v, _ = senv.done(state)
-            if game_over:
-                v = v * 2
-                self.executor.submit(self.update_tree, None, v, history)
-                break
-
-            with self.node_lock[state]:
-                if state not in self.tree:
-                    # Expand and Evaluate
-                    self.tree[state].sum_n = 1
-                    self.tree[state].legal_moves = senv.get_legal_moves(state)
-                    self.tree[state].waiting = True
-                    # logger.debug(f"expand_and_evaluate {state}, sum_n = {self.tree[state].sum_n}, history = {history}")
-                    if is_root_node and real_hist:
-                        self.expand_and_evaluate(state, history, real_hist)
-                    else:
-                        self.expand_and_evaluate(state, history)
+            key = pos.key
+            # logger.debug(f"start MCTS, key = {key}, history = {history}")
+            with self.node_lock[key]:
+                node = self.tree.get(key)
+                if node is None:
+                    # each state is classified once, finished games stay as unexpanded nodes
+                    node = self.tree[key]
+                    node.terminal = senv.board_done(pos.board)[1]
+                    if not node.terminal:
+                        # Expand and Evaluate
+                        node.sum_n = 1
+                        node.expand(*pos.legal_moves_and_labels())
+                        node.waiting = True
+                        if is_root_node and real_hist:
+                            self.expand_and_evaluate(pos, history, real_hist)
+                        else:
+                            self.expand_and_evaluate(pos, history)
+                        break
+
+                if node.terminal:
+                    self.executor.submit(self.update_tree, None, node.terminal * 2, history)
                     break
 
-                if state in history[:-1]: # loop
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            if senv.will_check_or_catch(state, history[i+1]):
-                                self.executor.submit(self.update_tree, None, -1, history)
-                            elif senv.be_catched(state, history[i+1]):
-                                self.executor.submit(self.update_tree, None, 1, history)
-                            else:
-                                # logger.debug(f"loop -> loss, state = {state}, history = {history[:-1]}")
-                                self.executor.submit(self.update_tree, None, 0, history)
-                            break
+                if key in history[:-1]: # loop
+                    self.executor.submit(self.update_tree, None, self.loop_value(pos, key, history), history)
                     break
 
                 # Select
-                node = self.tree[state]
                 if node.waiting:
-                    node.visit.append(history)
+                    if node.visit is None:
+                        node.visit = []
+                    node.visit.append((pos, history))
                     # logger.debug(f"wait for prediction state = {state}")
                     break
 
-                sel_action = self.select_action_q_and_u(state, is_root_node)
+                sel = self.select_action_q_and_u(key, is_root_node)
+                if sel is None:
+                    # no move left to search, a loss like a finished game
+                    self.executor.submit(self.update_tree, None, -2, history)
+                    break
 
                 virtual_loss = self.config.play.virtual_loss
-                self.tree[state].sum_n += 1
+                node.sum_n += 1
                 # logger.debug(f"node = {state}, sum_n = {node.sum_n}")
                 
-                action_state = self.tree[state].a[sel_action]
-                action_state.n += virtual_loss
-                action_state.w -= virtual_loss
-                action_state.q = action_state.w / action_state.n
+                node.a_n[sel] += virtual_loss
+                node.a_w[sel] -= virtual_loss
+                node.a_q[sel] = node.a_w[sel] / node.a_n[sel]
 
-                # logger.debug(f"apply virtual_loss = {virtual_loss}, as.n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
+                # logger.debug(f"apply virtual_loss = {virtual_loss}, n = {node.a_n[sel]}, w = {node.a_w[sel]}, q = {node.a_q[sel]}")
                 
-                # if action_state.next is None:
-                history.append(sel_action)
-                state = senv.step(state, sel_action)
-                history.append(state)
+                history.append(sel)
+                pos.make_move(node.legal_moves[sel])
+                history.append(pos.key)
                 # logger.debug(f"step action {sel_action}, next = {action_state.next}")
 
-    def select_action_q_and_u(self, state, is_root_node) -> str:
+    def batch_search(self, state, turns, hist, start_time):
+        '''
+        Single-threaded MCTS: descend to `search_threads` leaves with virtual loss, evaluate
+        them with one request to the neural network and back them all up
+        '''
+        key = self.root_state
+        root = senv.Position(state)
+        remaining = self.num_task
+        depth = 0
+        while remaining > 0 and not self.job_done and not self.tree_full():
+            leaves = []
+            done = 0
+            for i in range(min(self.config.play.search_threads, remaining)):
+                done += self.select_leaf(root.copy(), [key], hist, leaves)
+            if leaves:
+                self.pipe.send([planes for _, _, planes in leaves])
+                rets = self.pipe.recv()
+                for (leaf, history, _), (p, v) in zip(leaves, rets):
+                    leaf_key = history.pop()
+                    node = self.tree[leaf_key]
+                    node.p = p
+                    node.waiting = False
+                    if self.debugging:
+                        self.debug[leaf_key] = (p, v)
+                    self.backup(v, history)
+            remaining -= done
+            self.done_tasks += done
+            if self.uci and depth != self.done_tasks // 100:
+                # info depth xx pv xxx
+                depth = self.done_tasks // 100
+                _, value = self.debug[key]
+                self.print_depth_info(state, turns, start_time, value, self.no_act)
+
+    def select_leaf(self, pos, history, real_hist, leaves) -> int:
+        '''
+        Descend from the root applying virtual loss. A new leaf is appended to `leaves` with
+        its input planes, terminal and looping states are backed up at once. Return 0 if the
+        descent ran into a leaf that is already waiting in this batch (the virtual loss is
+        reverted and the simulation is retried in the next batch), otherwise 1
+        '''
+        virtual_loss = self.config.play.virtual_loss
+        while True:
+            key = pos.key
+            node = self.tree.get(key)
+            if node is None:
+                node = self.tree[key]
+                node.terminal = senv.board_done(pos.board)[1]
+                if not node.terminal:
+                    # Expand
+                    node.sum_n = 1
+                    node.expand(*pos.legal_moves_and_labels())
+                    node.waiting = True
+                    is_root = len(history) == 1
+                    leaves.append((pos, history, self.encode(pos, history, real_hist if is_root else None)))
+                    return 1
+
+            if node.terminal:
+                history.pop()
+                self.backup(node.terminal * 2, history)
+                return 1
+
+            if key in history[:-1]: # loop
+                v = self.loop_value(pos, key, history)
+                history.pop()
+                self.backup(v, history)
+                return 1
+
+            if node.waiting:
+                self.revert_virtual_loss(history)
+                return 0
+
+            sel = self.select_action_q_and_u(key, len(history) == 1)
+            if sel is None:
+                # no move left to search, a loss like a finished game
+                history.pop()
+                self.backup(-2, history)
+                return 1
+            node.sum_n += 1
+            node.a_n[sel] += virtual_loss
+            node.a_w[sel] -= virtual_loss
+            node.a_q[sel] = node.a_w[sel] / node.a_n[sel]
+            history.append(sel)
+            pos.make_move(node.legal_moves[sel])
+            history.append(pos.key)
+
+    def backup(self, v, history):
+        '''
+        Back up the value of a leaf along `history` (without the leaf itself), lock free
+        '''
+        virtual_loss = self.config.play.virtual_loss
+        while len(history) > 0:
+            sel = history.pop()
+            node = self.tree[history.pop()]
+            v = - v
+            node.a_n[sel] += 1 - virtual_loss
+            node.a_w[sel] += v + virtual_loss
+            node.a_q[sel] = node.a_w[sel] / node.a_n[sel]
+
+    def revert_virtual_loss(self, history):
+        virtual_loss = self.config.play.virtual_loss
+        history.pop()
+        while len(history) > 0:
+            sel = history.pop()
+            node = self.tree[history.pop()]
+            node.sum_n -= 1
+            node.a_n[sel] -= virtual_loss
+            node.a_w[sel] += virtual_loss
+            node.a_q[sel] = node.a_w[sel] / node.a_n[sel] if node.a_n[sel] > 0 else 0
+
+    def loop_value(self, pos, key, history):
+        '''
+        Value of a position repeated in the search path: lose if the repeating move checks or
+        catches, win if it escapes from being caught, otherwise draw (memoized per position and move)
+        '''
+        for i in range(0, len(history) - 1, 2):
+            if history[i] == key:
+                return senv.repetition_verdict(key, self.tree[key].legal_moves[history[i+1]], pos)
+        return 0
+
+    def select_action_q_and_u(self, key, is_root_node) -> int:
         '''
-        Select an action with highest Q(s,a) + U(s,a)
+        Select an action with highest Q(s,a) + U(s,a), return its index in node.legal_moves
+        or None if there is no move to select
         '''
-        is_root_node = self.root_state == state
-        # logger.debug(f"select_action_q_and_u for {state}, root = {is_root_node}")
-        node = self.tree[state]
-        legal_moves = node.legal_moves
+        is_root_node = self.root_state == key
+        # logger.debug(f"select_action_q_and_u for {key}, root = {is_root_node}")
+        node = self.tree[key]
 
-        # push p, the prior probability to the edge (node.p), only consider legal moves
+        # push p, the prior probability to the edge (node.a_p), only consider legal moves
         if node.p is not None:
-            all_p = 0
-            for mov in legal_moves:
-                mov_p = node.p[self.move_lookup[mov]]
-                node.a[mov].p = mov_p
-                all_p += mov_p
+            priors = node.p[node.labels]
+            all_p = priors.sum()
             # rearrange the distribution
             if all_p == 0:
                 all_p = 1
-            for mov in legal_moves:
-                node.a[mov].p /= all_p
+            node.a_p = priors / all_p
             # release the temp policy
             node.p = None
 
@@ -290,52 +502,63 @@ class CChessPlayer:
         c_puct = self.play_config.c_puct
         dir_alpha = self.play_config.dirichlet_alpha
 
-        best_score = -99999999
-        best_action = None
-        move_counts = len(legal_moves)
-
-        for mov in legal_moves:
-            if is_root_node and self.no_act and mov in self.no_act:
-                # logger.debug(f"mov = {mov}, no_act = {self.no_act}, continue")
-                continue
-            action_state = node.a[mov]
-            p_ = action_state.p
-            if is_root_node:
-                p_ = (1 - e) * p_ + e * np.random.dirichlet(dir_alpha * np.ones(move_counts))[0]
-            # Q + U
-            score = action_state.q + c_puct * p_ * xx_ / (1 + action_state.n)
-            # if score > 0.1 and is_root_node:
-            #     logger.debug(f"U+Q = {score:.2f}, move = {mov}, q = {action_state.q:.2f}")
-            if action_state.q > (1 - 1e-7):
-                best_action = mov
-                break
-            if score >= best_score:
-                best_score = score
-                best_action = mov
-
-        if best_action == None:
-            logger.error(f"Best action is None, legal_moves = {legal_moves}, best_score = {best_score}")
+        p_ = node.a_p
+        if is_root_node and e > 0:
+            if node.noise is None:
+                node.noise = np.random.dirichlet(dir_alpha * np.ones(len(p_)))
+            p_ = (1 - e) * p_ + e * node.noise
+        # Q + U
+        score = node.a_q + c_puct * xx_ * p_ / (1 + node.a_n)
+        win = node.a_q > (1 - 1e-7)
+
+        if is_root_node and self.no_act:
+            blocked = [i for i, mov in enumerate(node.legal_moves) if mov in self.no_act]
+            score[blocked] = -np.inf
+            win[blocked] = False
+
+        if win.any():
+            return int(np.argmax(win))
+        if len(score) == 0 or score.max() == -np.inf:
+            logger.error(f"Best action is None, legal_moves = {node.legal_moves}, no_act = {self.no_act}")
+            return None
         # if is_root_node:
-        #     logger.debug(f"selected action = {best_action}, with U + Q = {best_score}")
-        return best_action
+        #     logger.debug(f"selected action = {node.legal_moves[np.argmax(score)]}, with U + Q = {score.max()}")
+        return int(np.argmax(score))
 
-    def expand_and_evaluate(self, state, history, real_hist=None):
+    def expand_and_evaluate(self, pos, history, real_hist=None):
         '''
         Evaluate the state, return its policy and value computed by neural network
         '''
+        state_planes = self.encode(pos, history, real_hist)
+        with self.q_lock:
+            self.buffer_planes.append(state_planes)
+            self.buffer_history.append(history)
+            # logger.debug(f"EAE append buffer_history history = {history}")
+
+    def encode(self, pos, history, real_hist=None):
+        '''
+        Input planes of the neural network for the state at `pos`
+        '''
         if self.use_history:
+            state = pos.state
             if real_hist:
                 # logger.debug(f"real history = {real_hist}")
-                state_planes = senv.state_history_to_planes(state, real_hist)
+                return senv.state_history_to_planes(state, real_hist)
             else:
                 # logger.debug(f"history = {history}")
-                state_planes = senv.state_history_to_planes(state, history)
-        else:
-            state_planes = senv.state_to_planes(state)
-        with self.q_lock:
-            self.buffer_planes.append(state_planes)
-            self.buffer_history.append(history)
-            # logger.debug(f"EAE append buffer_history history = {history}")
+                return senv.state_history_to_planes(state, self.path_states(pos, history))
+        return senv.array_to_planes(pos.board)
+
+    def path_states(self, pos, history):
+        '''
+        Rebuild the state two plies back as a string, state_history_to_planes only reads history[-5]
+        '''
+        if len(history) < 5:
+            return history
+        pos = pos.copy()
+        pos.unmake_move()
+        pos.unmake_move()
+        return [pos.state] + history[-4:]
 
     def update_tree(self, p, v, history):
         state = history.pop()
@@ -348,23 +571,23 @@ class CChessPlayer:
                 node.waiting = False
                 if self.debugging:
                     self.debug[state] = (p, v)
-                for hist in node.visit:
-                    self.executor.submit(self.MCTS_search, state, hist)
-                node.visit = []
+                if node.visit:
+                    for pos, hist in node.visit:
+                        self.executor.submit(self.MCTS_search, pos, hist)
+                node.visit = None
 
         virtual_loss = self.config.play.virtual_loss
         # logger.debug(f"backup from {state}, v = {v}, history = {history}")
         while len(history) > 0:
-            action = history.pop()
+            sel = history.pop()
             state = history.pop()
             v = - v
             with self.node_lock[state]:
                 node = self.tree[state]
-                action_state = node.a[action]
-                action_state.n += 1 - virtual_loss
-                action_state.w += v + virtual_loss
-                action_state.q = action_state.w * 1.0 / action_state.n
-                # logger.debug(f"update value: state = {state}, action = {action}, n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
+                node.a_n[sel] += 1 - virtual_loss
+                node.a_w[sel] += v + virtual_loss
+                node.a_q[sel] = node.a_w[sel] / node.a_n[sel]
+                # logger.debug(f"update value: state = {state}, action = {sel}, n = {node.a_n[sel]}, w = {node.a_w[sel]}, q = {node.a_q[sel]}")
 
         with self.t_lock:
             self.num_task -= 1
@@ -376,35 +599,43 @@ class CChessPlayer:
         '''
         calculate π(a|s0) according to the visit count
         '''
-        node = self.tree[state]
+        node = self.tree[senv.state_key(state)]
         policy = np.zeros(self.labels_n)
         max_q_value = -100
-        debug_result = {}
 
-        for mov, action_state in node.a.items():
-            policy[self.move_lookup[mov]] = action_state.n
-            if no_act and mov in no_act:
-                policy[self.move_lookup[mov]] = 0
-                continue
-            if self.debugging:
-                debug_result[mov] = (action_state.n, action_state.q, action_state.p)
-            if action_state.q > max_q_value:
-                max_q_value = action_state.q
+        if node.a_n is not None and len(node.a_n) > 0:
+            policy[node.labels] = node.a_n
+            q = node.a_q
+            if no_act:
+                blocked = [i for i, mov in enumerate(node.legal_moves) if mov in no_act]
+                policy[node.labels[blocked]] = 0
+                q = q.copy()
+                q[blocked] = -100
+            max_q_value = q.max()
 
         if max_q_value < self.play_config.resign_threshold and self.enable_resign and turns > self.play_config.min_resign_turn:
             return policy, True
 
         if self.debugging:
-            temp = sorted(range(len(policy)), key=lambda k: policy[k], reverse=True)
-            for i in range(5):
-                index = temp[i]
-                mov = ActionLabelsRed[index]
-                if mov in debug_result:
-                    self.search_results[mov] = debug_result[mov]
+            for i in np.argsort(-policy[node.labels], kind='stable')[:5]:
+                mov = node.legal_moves[i]
+                if not no_act or mov not in no_act:
+                    self.search_results[mov] = (node.a_n[i], node.a_q[i], node.a_p[i])
 
         policy /= np.sum(policy)
         return policy, False
 
+    def visit_counts(self, state, no_act=None, k=None):
+        '''
+        Visit counts of the moves searched at `state` as [[label, visits], ...], the k most visited
+        '''
+        node = self.tree.get(senv.state_key(state))
+        if node is None or node.a_n is None:
+            return []
+        visits = [[int(node.labels[i]), int(min(node.a_n[i], 65535))] for i in np.argsort(-node.a_n, kind='stable')
+                  if node.a_n[i] > 0 and (not no_act or node.legal_moves[i] not in no_act)]
+        return visits[:k] if k else visits
+
     def print_depth_info(self, state, turns, start_time, value, no_act):
         '''
         info depth xx pv xxx
@@ -413,23 +644,22 @@ class CChessPlayer:
         end_time = time()
         pv = ""
         i = 0
+        pos = senv.Position(state)
         while i < 20:
-            node = self.tree[state]
+            node = self.tree[pos.key]
             bestmove = None
             root = True
-            n = 0
-            if len(node.a) == 0:
+            if node.a_n is None or len(node.a_n) == 0:
                 break
-            for mov, action_state in node.a.items():
-                if action_state.n >= n:
-                    if root and no_act and mov in no_act:
-                        continue
-                    n = action_state.n
-                    bestmove = mov
+            n = node.a_n.copy()
+            if root and no_act:
+                n[[k for k, mov in enumerate(node.legal_moves) if mov in no_act]] = -1
+            if n.max() >= 0:
+                bestmove = node.legal_moves[len(n) - 1 - int(np.argmax(n[::-1]))]
             if bestmove is None:
-                logger.error(f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(node.a)}")
+                logger.error(f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(node.a_n)}")
                 break
-            state = senv.step(state, bestmove)
+            pos.make_move(bestmove)
             root = False
             if turns % 2 == 1:
                 bestmove = flip_move(bestmove)
@@ -437,8 +667,8 @@ class CChessPlayer:
             pv += " " + bestmove
             i += 1
             turns += 1
-        if state in self.debug:
-            _, value = self.debug[state]
+        if pos.key in self.debug:
+            _, value = self.debug[pos.key]
             if turns % 2 != self.side:
                 value = -value
         score = int(value * 1000)
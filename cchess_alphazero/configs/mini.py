@@ -28,6 +28,10 @@ class PlayDataConfig:
         self.nb_game_in_file = 1
         self.max_file_num = 10
         self.nb_game_save_record = 1
+        self.binary_format = False  # save self-play games in binary containers instead of JSON
+        self.visit_top_k = 16  # most visited moves stored with each move as policy target (0 = none)
+        self.max_play_data_mb = 0  # also delete the oldest game files beyond this size (0 = no limit)
+        self.manifest_sync_interval = 600  # seconds between scans of play_data for files missing in the manifest
 
 
 class PlayConfig:
@@ -44,6 +48,16 @@ class PlayConfig:
         self.max_game_length = 100
         self.share_mtcs_info_in_self_play = False
         self.reset_mtcs_info_per_game = 5
+        self.max_tree_nodes = 100000 # max nodes in the search tree, a search stops when it is full
+        self.batched_search = False  # single-threaded search evaluating search_threads leaves per batch
+        self.games_per_process = 1  # games played at the same time by each self-play process
+        self.shared_memory_transport = False  # pass planes and results to the model through shared memory (Python 3.8+)
+        self.batch_max_size = 0  # max states in one prediction batch, 0 = no limit
+        self.batch_max_wait_us = 0  # wait up to this long after the first request for more requests
+        self.batch_adaptive_wait = False  # stop waiting earlier when requests arrive slowly
+        self.eval_cache_size = 0  # positions in the evaluation cache of the model, 0 = no cache
+        self.eval_cache_mb = 0  # size of the evaluation cache in MB, overrides eval_cache_size
+        self.eval_cache_mirror = True  # mirrored states share one entry of the evaluation cache
         self.enable_resign_rate = 0.1
         self.resign_threshold = -0.92
         self.min_resign_turn = 20
@@ -69,6 +83,13 @@ class TrainerConfig:
         ]
         self.sl_game_step = 10000
         self.load_step = 6
+        self.mirror_augment = False  # also train on the left-right mirror of every position
+        self.use_replay_buffer = False  # keep dataset_size positions in a memory-mapped buffer on disk
+        self.policy_k = 16  # most visited moves per position used as policy target (1 = played move only)
+        self.replay_policy_k = 8  # (label, probability) pairs stored per position in the replay buffer
+        self.streaming = False  # train on batches streamed from the files while the next ones are decoded
+        self.stream_shuffle_size = 20000  # positions shuffled together when streaming
+        self.stream_prefetch = 8  # batches prepared ahead of training when streaming
 
 class ModelConfig:
     def __init__(self):
@@ -167,14 +167,14 @@ class L_Chessboard:
                             if (ch == 'K' or ch == 'A') and y_ < 7:
                                 continue
                         _legal_moves.append(move_to_str(x, y, x_, y_))
-                        if (ch == 'k' and self.turn == RED): #for King to King check
-                            d, u = self._y_board_from(x, y)
-                            if (u < self.height and self.board[u][x] == 'K'):
-                                _legal_moves.append(move_to_str(x, y, x, u))
-                        elif (ch == 'K' and self.turn == BLACK):
-                            d, u = self._y_board_from(x, y)
-                            if (d > -1 and self.board[d][x] == 'k'):
-                                _legal_moves.append(move_to_str(x, y, x, d))
+                    if (ch == 'k' and self.turn == RED): #for King to King check
+                        d, u = self._y_board_from(x, y)
+                        if (u < self.height and self.board[u][x] == 'K'):
+                            _legal_moves.append(move_to_str(x, y, x, u))
+                    elif (ch == 'K' and self.turn == BLACK):
+                        d, u = self._y_board_from(x, y)
+                        if (d > -1 and self.board[d][x] == 'k'):
+                            _legal_moves.append(move_to_str(x, y, x, d))
                 elif ch != '.': # for connon and root
                     l,r = self._x_board_from(x,y)
                     d,u = self._y_board_from(x,y)
@@ -55,6 +55,10 @@ def flip_move(x):
     new = ''.join([new, str(9 - int(x[3]))])
     return new
 
+def mirror_move(x):
+    # left-right reflection, the rows are unchanged
+    return str(8 - int(x[0])) + x[1] + str(8 - int(x[2])) + x[3]
+
 def flip_action_labels(labels):
     return [flip_move(x) for x in labels]
 
@@ -134,8 +138,40 @@ def create_action_labels():
 ActionLabelsRed = create_action_labels()
 ActionLabelsBlack = flip_action_labels(ActionLabelsRed)
 
+# move string -> index of ActionLabelsRed
+Move_2_Idx = {move: i for i, move in enumerate(ActionLabelsRed)}
+
+def create_label_squares(labels):
+    '''
+    (from, to) squares of every label, squares are numbered like the compact board of
+    static_env: (9 - row) * 9 + col
+    '''
+    squares = np.zeros((len(labels), 2), dtype=np.int16)
+    for i, move in enumerate(labels):
+        squares[i, 0] = (9 - int(move[1])) * 9 + int(move[0])
+        squares[i, 1] = (9 - int(move[3])) * 9 + int(move[2])
+    return squares
+
+Idx_2_Sq = create_label_squares(ActionLabelsRed)
+
 Unflipped_index = [ActionLabelsRed.index(x) for x in ActionLabelsBlack]
 
 def flip_policy(pol):
     global Unflipped_index
-    return np.asarray([pol[ind] for ind in Unflipped_index])
+    return np.asarray(pol)[Unflipped_index]
+
+Mirrored_index = [Move_2_Idx[mirror_move(x)] for x in ActionLabelsRed]
+
+def mirror_policy(pol):
+    '''
+    Policy of the left-right mirrored state, works on a batch of policies too
+    '''
+    return np.asarray(pol)[..., Mirrored_index]
+
+def densify_policy(labels, probs):
+    '''
+    Dense policies (N x len(ActionLabelsRed)) of sparse targets: N x k labels and their probabilities
+    '''
+    policy = np.zeros((len(labels), len(ActionLabelsRed)), dtype=np.float32)
+    np.add.at(policy, (np.arange(len(labels))[:, None], labels), probs)
+    return policy
@@ -0,0 +1,185 @@
+'''
+Perft: count the move paths to a given depth from reference positions with each move
+generator (static_env, the light_env L_Chessboard and the Chessboard / Chessman objects),
+to cross-check them and measure their speed in nodes per second.
+All generators are pseudo-legal (a move may leave the own king attacked, the kings may
+capture each other across an open file), and a position without one of the kings has no moves.
+The pseudo-legal reference counts of Perft_Positions were generated by static_env itself:
+matching them only shows that the generators agree with each other and with earlier versions
+of static_env, not that they are right. The independent check is `static_env legal`, which
+filters the static_env moves leaving the own king attacked and is compared with the published
+legal counts of Legal_Perft.
+'''
+import copy
+from time import time
+
+import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.environment.light_env.chessboard import L_Chessboard
+from cchess_alphazero.environment.light_env.common import RED
+from cchess_alphazero.environment.chessboard import Chessboard
+from cchess_alphazero.environment.chessman import Rook, Knight, Cannon, Mandarin, Elephant, Pawn, King
+
+# (name, FEN, pseudo-legal counts for depth 1, 2, ...). They were generated by static_env itself
+# (and agree with light_env and, to depth 2, the Chessboard objects), so they only catch
+# regressions and disagreements between the generators, see Legal_Perft for an independent check
+Perft_Positions = [
+    ('start', 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1',
+     [44, 1926, 80288, 3343044]),
+    ('check', '1nbak2R1/r3a4/3R4b/p1c1p3p/P5p2/9/2c1P1P1P/4K3N/9/1NBA1AB2 b - - 0 55',
+     [33, 1410, 47256, 1912829]),
+    ('check2', '2b1kabcr/4a4/n8/6pn1/p7p/P1P1p1P2/5R2P/1R2B4/8N/3rKA3 w - - 0 70',
+     [39, 1494, 54938, 2123320]),
+    ('captures', '2rk1ab1r/n3a4/9/2p1p1Cn1/2b1P4/R3PN2p/8P/2N6/c8/2BAKAB1R w - - 0 76',
+     [45, 1605, 72417, 2609983]),
+    ('endgame', '3k5/4a4/4ba3/9/9/9/4P4/9/4A4/3AK1R2 w - - 0 1',
+     [17, 136, 2359, 16799]),
+    ('cannon', '4k4/9/9/9/9/9/9/9/4C4/3K5 w - - 0 1',
+     [18, 54, 969, 2790]),
+]
+
+# published legal move counts of xiangqi for depth 1, 2, ...
+Legal_Perft = {
+    'start': [44, 1920, 79666, 3290240],
+}
+
+def fen_to_state(fen):
+    '''
+    State (seen from the side to move) of a FEN, red is upper case
+    '''
+    state = senv.fen_to_state(fen)
+    if fen.split(' ')[1] == 'b':
+        state = senv.fliped_state(state)
+    return state
+
+def has_kings(state):
+    return 's' in state and 'S' in state
+
+def perft_static(pos, depth):
+    board = pos.board
+    if board.find(senv.KING_CODE) < 0 or board.find(senv.KING_CODE + senv.OPPONENT) < 0:
+        return 0
+    moves = pos.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for mov in moves:
+        pos.make_move(mov)
+        nodes += perft_static(pos, depth - 1)
+        pos.unmake_move()
+    return nodes
+
+def perft_legal(pos, depth):
+    '''
+    Perft of legal moves: after a legal move the opponent can not capture the king
+    (which includes the kings facing each other)
+    '''
+    nodes = 0
+    for mov in pos.legal_moves():
+        pos.make_move(mov)
+        if not senv.attackers(pos.board, pos.board.find(senv.KING_CODE + senv.OPPONENT)):
+            nodes += 1 if depth == 1 else perft_legal(pos, depth - 1)
+        pos.unmake_move()
+    return nodes
+
+def light_board(state):
+    board = L_Chessboard()
+    # state_to_board puts the side to move at the bottom in lower case, like red in L_Chessboard
+    board.board = senv.state_to_board(state)
+    board.turn = RED
+    return board
+
+def perft_light(board, depth):
+    if not any('k' in row for row in board.board) or not any('K' in row for row in board.board):
+        return 0
+    moves = board.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for mov in moves:
+        rows, turn, steps = [row[:] for row in board.board], board.turn, board.steps
+        board.move_action_str(mov)
+        nodes += perft_light(board, depth - 1)
+        board.board, board.turn, board.steps, board._legal_moves = rows, turn, steps, None
+    return nodes
+
+_Chessman_Classes = {'r': (Rook, 'rook'), 'n': (Knight, 'knight'), 'c': (Cannon, 'cannon'), 'a': (Mandarin, 'mandarin'),
+                     'b': (Elephant, 'elephant'), 'p': (Pawn, 'pawn'), 'k': (King, 'king')}
+
+def heavy_board(state):
+    board = Chessboard()
+    counts = {}
+    for y, row in enumerate(senv.state_to_board(state)):
+        for x, ch in enumerate(row):
+            if ch == '.':
+                continue
+            # the side to move (lower case in state_to_board) plays red from the bottom
+            is_red = ch.islower()
+            color = 'red' if is_red else 'black'
+            cls, name = _Chessman_Classes[ch.lower()]
+            counts[ch] = counts.get(ch, 0) + 1
+            name = f"{color}_{name}" if cls is King else f"{color}_{name}_{counts[ch]}"
+            cls(name, name, is_red, board, ch.upper() if is_red else ch.lower()).add_to_board(x, y)
+    board.calc_chessmans_moving_list()
+    return board
+
+def perft_heavy(board, depth):
+    if not board.get_chessman_by_name('red_king') or not board.get_chessman_by_name('black_king'):
+        return 0
+    moves = board.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for mov in moves:
+        child = copy.deepcopy(board)
+        x0, y0, x1, y1 = child.str_to_move(mov)
+        chessman = child.chessmans[x0][y0]
+        child.remove_chessman_source(x0, y0)
+        chessman.position.x, chessman.position.y = x1, y1
+        child.move_chessman(chessman, x1, y1)
+        child.calc_chessmans_moving_list()
+        nodes += perft_heavy(child, depth - 1)
+    return nodes
+
+# name -> (builder of the root from a state, perft function)
+Generators = {
+    'static_env': (senv.Position, perft_static),
+    'static_env legal': (senv.Position, perft_legal),
+    'light_env': (light_board, perft_light),
+    'chessboard': (heavy_board, perft_heavy),
+}
+
+def perft(state, depth, generator='static_env'):
+    '''
+    Number of move paths of `depth` plies from `state` and the seconds it took
+    '''
+    build, count = Generators[generator]
+    start = time()
+    nodes = count(build(state), depth)
+    return nodes, time() - start
+
+def start(depth=3, heavy_depth=2):
+    '''
+    Run perft on the reference positions with all generators and report mismatches against
+    the reference counts (the published legal counts for `static_env legal`). The Chessboard
+    objects only run up to `heavy_depth`: they are much slower, and they end the game on
+    facing kings instead of generating the king capture
+    '''
+    ok = True
+    for name, fen, reference in Perft_Positions:
+        state = fen_to_state(fen)
+        for d in range(1, depth + 1):
+            results = []
+            for generator in Generators:
+                if generator == 'chessboard' and d > heavy_depth:
+                    continue
+                nodes, seconds = perft(state, d, generator)
+                results.append((generator, nodes, seconds))
+            for generator, nodes, seconds in results:
+                counts = Legal_Perft.get(name, []) if generator == 'static_env legal' else reference
+                expected = counts[d - 1] if d <= len(counts) else None
+                match = expected is None or nodes == expected
+                ok = ok and match
+                print(f"{name:<10} depth {d} {generator:<16} {nodes:>10} nodes {seconds:8.3f}s "
+                      f"{nodes / max(seconds, 1e-9):>10.0f} nodes/s{'' if match else f'  MISMATCH, expected {expected}'}")
+    print("perft: all counts match the references" if ok else "perft: MISMATCH")
+    return ok
@@ -1,7 +1,7 @@
 import numpy as np
 
 from cchess_alphazero.environment.light_env.common import *
-from cchess_alphazero.environment.lookup_tables import Winner, Fen_2_Idx, flip_move
+from cchess_alphazero.environment.lookup_tables import Idx_2_Sq
 from logging import getLogger
 
 logger = getLogger(__name__)
@@ -11,91 +11,277 @@ INIT_STATE = 'rkemsmekr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR'
 BOARD_HEIGHT = 10
 BOARD_WIDTH = 9
 
-def done(state, turns=-1, need_check=False):
-    if 's' not in state:
-        return (True, 1, None)
-    if 'S' not in state:
-        return (True, -1, None)
-    # if turns > 0 and turns < 20:
-    #     return (False, 0, None)
-    board = state_to_board(state)
-    red_k, black_k = [0, 0], [0, 0]
-    winner = None
-    v = 0
-    for i in range(BOARD_HEIGHT):
-        for j in range(BOARD_WIDTH):
-            if board[i][j] == 'k':
-                red_k[0] = i
-                red_k[1] = j
-            if board[i][j] == 'K':
-                black_k[0] = i
-                black_k[1] = j
-    if red_k[0] == 0 and red_k[1] == 0:
-        winner = Winner.black
-        v = -1
-    elif black_k[0] == 0 and black_k[1] == 0:
-        winner = Winner.red
-        v = 1
-    elif red_k[1] == black_k[1]:
-        has_block = False
-        i = red_k[0] + 1
-        while i < black_k[0]:
-            if board[i][red_k[1]] != '.':
-                has_block = True
-                break
-            i += 1
-        if not has_block:
-            v = 1
-            winner = Winner.red
-    final_move = None
-    check = False
-    if winner is None:
-        legal_moves = get_legal_moves(state, board)
-        for mov in legal_moves:
-            dest = [int(mov[3]), int(mov[2])]
-            if dest == black_k:
-                winner = Winner.red
-                v = 1
-                final_move = mov
-                break
-    if winner is None and need_check:
-        black_state = fliped_state(state)
-        black_moves = get_legal_moves(black_state)
-        # render(black_state)
-        red_k[0] = 9 - red_k[0]
-        red_k[1] = 8 - red_k[1]
-        for mov in black_moves:
-            dest = [int(mov[3]), int(mov[2])]
-            if dest == red_k:
-                check = True
-                # logger.debug(f"Checking move {mov}")
+# Compact board: a 90-byte bytearray laid out in the same order as the state string
+# (row 9 first), so square index = (9 - y) * 9 + x and flipping the board is a reverse.
+# Codes: 1 ~ 7 for the side to move (upper case in state, Fen_2_Idx + 1),
+#        9 ~ 15 for the opponent (lower case in state)
+EMPTY = 0
+OPPONENT = 8
+_STATE_CHARS = b'.PCRKEMS.pcrkems'
+_CODE_2_CHAR = bytes.maketrans(bytes(range(16)), _STATE_CHARS)
+_CHAR_2_CODE = bytes.maketrans(_STATE_CHARS[1:8] + _STATE_CHARS[9:] + b'.',
+                               bytes(range(1, 8)) + bytes(range(9, 16)) + b'\x00')
+_SWAP_SIDE = bytes.maketrans(bytes(range(16)), bytes([0]) + bytes(range(9, 16)) + bytes([8]) + bytes(range(1, 8)))
+_EXPAND_STATE = {ord(str(i)): '.' * i for i in range(1, 10)}
+_EXPAND_STATE[ord('/')] = None
+_COMPRESS_RUNS = [('.' * i, str(i)) for i in range(9, 0, -1)]
+
+def xy_to_sq(x, y):
+    return (BOARD_HEIGHT - 1 - y) * BOARD_WIDTH + x
+
+# move string -> (from square, to square)
+Move_2_Sq = {f'{x0}{y0}{x1}{y1}': (xy_to_sq(x0, y0), xy_to_sq(x1, y1))
+             for x0 in range(BOARD_WIDTH) for y0 in range(BOARD_HEIGHT)
+             for x1 in range(BOARD_WIDTH) for y1 in range(BOARD_HEIGHT)}
+
+# Zobrist keys, indexed by code * 90 + square.  States are always seen from the side to move,
+# so a Position keeps the key of its own view and of the flipped (opponent) view, and
+# swaps the two after each move.
+_zobrist_rng = np.random.RandomState(20180401)
+Zobrist = [0] * (16 * 90)
+for _code in list(range(1, 8)) + list(range(9, 16)):
+    for _sq in range(90):
+        Zobrist[_code * 90 + _sq] = int(_zobrist_rng.randint(1, 2 ** 63, dtype=np.int64))
+Zobrist_Flip = [Zobrist[_SWAP_SIDE[i // 90] * 90 + 89 - i % 90] for i in range(16 * 90)]
+
+PAWN_CODE, CANNON_CODE, ROOK_CODE, KNIGHT_CODE, ELEPHANT_CODE, ADVISOR_CODE, KING_CODE = range(1, 8)
+
+def _on_board(x, y):
+    return 0 <= x < BOARD_WIDTH and 0 <= y < BOARD_HEIGHT
+
+def _build_step_table(dirs, allow):
+    table = []
+    for sq in range(90):
+        x, y = sq % BOARD_WIDTH, BOARD_HEIGHT - 1 - sq // BOARD_WIDTH
+        table.append(tuple(xy_to_sq(x + dx, y + dy) for dx, dy in dirs
+                           if _on_board(x + dx, y + dy) and allow(x, y, x + dx, y + dy)))
+    return table
+
+def _build_leg_table(dirs, allow):
+    table = []
+    for sq in range(90):
+        x, y = sq % BOARD_WIDTH, BOARD_HEIGHT - 1 - sq // BOARD_WIDTH
+        table.append(tuple((xy_to_sq(x + dx, y + dy), xy_to_sq(x + int(dx / 2), y + int(dy / 2)))
+                           for dx, dy in dirs if _on_board(x + dx, y + dy) and allow(x + dx, y + dy)))
+    return table
+
+def _in_palace(x, y):
+    return 3 <= x <= 5 and y <= 2
+
+# Precomputed targets per square (side to move is always at the bottom, y = 0 ~ 4):
+# knight / elephant entries are (to, blocking square), rays are [left, right, down, up] near to far
+Knight_Table = _build_leg_table(mov_dir['n'], lambda x, y: True)
+Elephant_Table = _build_leg_table(mov_dir['b'], lambda x, y: y <= 4)
+Step_Tables = {
+    PAWN_CODE: _build_step_table(mov_dir['p'], lambda x, y, x_, y_: y >= 5 or x_ == x),
+    ADVISOR_CODE: _build_step_table(mov_dir['a'], lambda x, y, x_, y_: _in_palace(x_, y_)),
+    KING_CODE: _build_step_table(mov_dir['k'], lambda x, y, x_, y_: _in_palace(x_, y_)),
+}
+Ray_Table = []
+for _sq in range(90):
+    _x, _y = _sq % BOARD_WIDTH, BOARD_HEIGHT - 1 - _sq // BOARD_WIDTH
+    Ray_Table.append((tuple(xy_to_sq(x, _y) for x in range(_x - 1, -1, -1)),
+                      tuple(xy_to_sq(x, _y) for x in range(_x + 1, BOARD_WIDTH)),
+                      tuple(xy_to_sq(_x, y) for y in range(_y - 1, -1, -1)),
+                      tuple(xy_to_sq(_x, y) for y in range(_y + 1, BOARD_HEIGHT))))
+# same scan order as the board (y = 0 ~ 9, x = 0 ~ 8) so moves come out in a stable order
+_SCAN_ORDER = [xy_to_sq(x, y) for y in range(BOARD_HEIGHT) for x in range(BOARD_WIDTH)]
+_SCAN_RANK = [0] * 90
+for _i, _sq in enumerate(_SCAN_ORDER):
+    _SCAN_RANK[_sq] = _i
+# Reverse tables for attack queries: target square -> squares a piece of the side to move
+# reaches it from (with the blocking square for knights and elephants)
+def _reverse_table(table, legs):
+    reverse = [[] for _ in range(90)]
+    for sq in range(90):
+        for entry in table[sq]:
+            if legs:
+                reverse[entry[0]].append((sq, entry[1]))
+            else:
+                reverse[entry].append(sq)
+    return [tuple(x) for x in reverse]
+Knight_Attack_Table = _reverse_table(Knight_Table, True)
+Elephant_Attack_Table = _reverse_table(Elephant_Table, True)
+Step_Attack_Tables = tuple((code, _reverse_table(table, False)) for code, table in Step_Tables.items())
+# piece code -> input plane, 0 ~ 7 : side to move (upper), 7 ~ 14: opponent (lower)
+Code_2_Plane = np.array([max((code & 7) - 1, 0) + 7 * (code >> 3) for code in range(16)], dtype=np.intp)
+# move code (from * 90 + to) -> move string
+Code_2_Move = [None] * (90 * 90)
+for _mov, (_src, _dst) in Move_2_Sq.items():
+    Code_2_Move[_src * 90 + _dst] = _mov
+# move code -> index of ActionLabelsRed (-1 if the move has no label)
+Code_2_Label = np.full(90 * 90, -1, dtype=np.int32)
+Code_2_Label[Idx_2_Sq[:, 0].astype(np.int32) * 90 + Idx_2_Sq[:, 1]] = np.arange(len(Idx_2_Sq), dtype=np.int32)
+
+def state_to_array(state):
+    return bytearray(state.translate(_EXPAND_STATE).encode().translate(_CHAR_2_CODE))
+
+def array_to_state(arr):
+    chars = arr.translate(_CODE_2_CHAR).decode()
+    state = '/'.join([chars[i:i + BOARD_WIDTH] for i in range(0, 90, BOARD_WIDTH)])
+    for run, n in _COMPRESS_RUNS:
+        state = state.replace(run, n)
+    return state
+
+def array_key(arr):
+    key = 0
+    for sq, code in enumerate(arr):
+        if code:
+            key ^= Zobrist[code * 90 + sq]
+    return key
+
+def state_key(state):
+    '''
+    Zobrist key of a state (fits in an int64), equal to `Position(state).key`
+    '''
+    return array_key(state_to_array(state))
+
+class Position:
+    '''
+    Mutable board for search: moves are made and unmade in place and the state string
+    is only built when `state` is read.
+    '''
+    __slots__ = ('board', 'stack', 'key', 'flip_key')
+
+    def __init__(self, state=INIT_STATE):
+        self.board = state_to_array(state)
+        self.stack = []             # (from, to, captured, key, flip_key) for each move made
+        self.key = array_key(self.board)
+        self.flip_key = array_key(self.board[::-1].translate(_SWAP_SIDE))
+
+    @property
+    def state(self):
+        return array_to_state(self.board)
+
+    def copy(self):
+        pos = Position.__new__(Position)
+        pos.board = bytearray(self.board)
+        pos.stack = list(self.stack)
+        pos.key = self.key
+        pos.flip_key = self.flip_key
+        return pos
+
+    def make_move(self, action):
+        '''
+        Play `action` (in the coordinates of the side to move) and flip the board,
+        return the captured piece code (0 if none)
+        '''
+        board = self.board
+        src, dst = Move_2_Sq[action]
+        if board[src] == EMPTY:
+            raise ValueError(f"No chessman in {action}, state = {self.state}")
+        piece = board[src]
+        captured = board[dst]
+        self.stack.append((src, dst, captured, self.key, self.flip_key))
+        key = self.key ^ Zobrist[piece * 90 + src] ^ Zobrist[piece * 90 + dst]
+        flip_key = self.flip_key ^ Zobrist_Flip[piece * 90 + src] ^ Zobrist_Flip[piece * 90 + dst]
+        if captured:
+            key ^= Zobrist[captured * 90 + dst]
+            flip_key ^= Zobrist_Flip[captured * 90 + dst]
+        board[dst] = piece
+        board[src] = EMPTY
+        board.reverse()
+        self.board = board.translate(_SWAP_SIDE)
+        self.key, self.flip_key = flip_key, key
+        return captured
+
+    def unmake_move(self):
+        src, dst, captured, self.key, self.flip_key = self.stack.pop()
+        board = self.board.translate(_SWAP_SIDE)
+        board.reverse()
+        board[src] = board[dst]
+        board[dst] = captured
+        self.board = board
+
+    def legal_moves(self):
+        return [Code_2_Move[code] for code in generate_moves(self.board)]
+
+    def legal_labels(self):
+        return Code_2_Label[generate_moves(self.board)]
+
+    def legal_moves_and_labels(self):
+        codes = generate_moves(self.board)
+        return [Code_2_Move[code] for code in codes], Code_2_Label[codes]
+
+def attackers(board, sq):
+    '''
+    Squares of the pieces of the side to move that can move to `sq` on a compact board
+    (the same moves as generate_moves, `sq` may be empty)
+    '''
+    found = []
+    for i, ray in enumerate(Ray_Table[sq]):
+        screen = False
+        for s in ray:
+            piece = board[s]
+            if piece == EMPTY:
+                continue
+            if screen:
+                if piece == CANNON_CODE:
+                    found.append(s)
                 break
-        # logger.debug(f"red_k = {red_k}, black_moves = {black_moves}, check = {check}")
-    if need_check:
-        return (winner is not None, v, final_move, check)
+            if piece == ROOK_CODE or (i == 2 and piece == KING_CODE and board[sq] == KING_CODE + OPPONENT):
+                found.append(s)
+            screen = True
+    for s, leg in Knight_Attack_Table[sq]:
+        if board[s] == KNIGHT_CODE and board[leg] == EMPTY:
+            found.append(s)
+    for s, leg in Elephant_Attack_Table[sq]:
+        if board[s] == ELEPHANT_CODE and board[leg] == EMPTY:
+            found.append(s)
+    for code, table in Step_Attack_Tables:
+        for s in table[sq]:
+            if board[s] == code:
+                found.append(s)
+    return found
+
+def in_check(board):
+    '''
+    Whether the king of the side to move is attacked on a compact board
+    '''
+    king = board.find(KING_CODE)
+    return king >= 0 and len(attackers(board[::-1].translate(_SWAP_SIDE), 89 - king)) > 0
+
+def board_done(board, need_check=False):
+    '''
+    Same as `done` on a compact board: the kings are found with a byte search and the
+    capture of the opponent king (and the check if need_check) with attack queries from
+    the king squares instead of generating all moves
+    '''
+    king, opp_king = board.find(KING_CODE), board.find(KING_CODE + OPPONENT)
+    over, v, final_move, check = False, 0, None, False
+    if opp_king < 0:
+        over, v = True, 1
+    elif king < 0:
+        over, v = True, -1
     else:
-        return (winner is not None, v, final_move)
+        found = attackers(board, opp_king)
+        if found:
+            over, v = True, 1
+            if king not in found:
+                final_move = Code_2_Move[min(found, key=_SCAN_RANK.__getitem__) * 90 + opp_king]
+            # else the kings face each other, which ends the game without a final move
+        elif need_check:
+            check = len(attackers(board[::-1].translate(_SWAP_SIDE), 89 - king)) > 0
+    if need_check:
+        return (over, v, final_move, check)
+    return (over, v, final_move)
+
+def done(state, turns=-1, need_check=False):
+    return board_done(state_to_array(state), need_check)
 
 def step(state, action):
-    board = state_to_board(state)
-    if board[int(action[1])][int(action[0])] == '.':
-        raise ValueError(f"No chessman in {action}, state = {state}")
-    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
-    board[int(action[1])][int(action[0])] = '.'
-    state = board_to_state(board)
-    return fliped_state(state)
+    return new_step(state, action)[0]
 
 def new_step(state, action):
-    no_eat = True
-    board = state_to_board(state)
-    if board[int(action[1])][int(action[0])] == '.':
+    board = state_to_array(state)
+    src, dst = Move_2_Sq[action]
+    if board[src] == EMPTY:
         raise ValueError(f"No chessman in {action}, state = {state}")
-    if board[int(action[3])][int(action[2])] != '.':
-        no_eat = False
-    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
-    board[int(action[1])][int(action[0])] = '.'
-    state = board_to_state(board)
-    return fliped_state(state), no_eat
+    no_eat = board[dst] == EMPTY
+    board[dst] = board[src]
+    board[src] = EMPTY
+    board.reverse()
+    return array_to_state(board.translate(_SWAP_SIDE)), no_eat
 
 def evaluate(state):
     piece_vals = {'R': 14, 'K': 7, 'E': 3, 'M': 2, 'S':1, 'C': 5, 'P': 1} # for RED account
@@ -140,19 +326,16 @@ def state_to_planes(state):
         rkemsmekr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
         rkemsmek1/8r/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
     '''
+    return array_to_planes(state_to_array(state))
+
+def array_to_planes(arr):
+    '''
+    14 x 10 x 9 input planes of a compact board
+    '''
     planes = np.zeros(shape=(14, 10, 9), dtype=np.float32)
-    rows = state.split('/')
-
-    for i in range(len(rows)):
-        row = rows[i]
-        j = 0
-        for letter in row:
-            if letter.isalpha():
-                # 0 ~ 7 : upper, 7 ~ 14: lower
-                planes[Fen_2_Idx[letter] + int(letter.islower()) * 7][i][j] = 1
-                j += 1
-            else:
-                j += int(letter)
+    codes = np.frombuffer(arr, dtype=np.uint8)
+    squares = codes.nonzero()[0]
+    planes.reshape(14, 90)[Code_2_Plane[codes[squares]], squares] = 1
     return planes
 
 def state_history_to_planes(state, history):
@@ -162,36 +345,54 @@ def state_history_to_planes(state, history):
         rkemsmek1/8r/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
     '''
     # logger.debug(f"state = {state}")
-    planes = np.zeros(shape=(28, 10, 9), dtype=np.float32)
-    rows = state.split('/')
-    # 0 ~ 14 for current state
-    for i in range(len(rows)):
-        row = rows[i]
-        j = 0
-        for letter in row:
-            if letter.isalpha():
-                # 0 ~ 7 : upper, 7 ~ 14: lower
-                planes[Fen_2_Idx[letter] + int(letter.islower()) * 7][i][j] = 1
-                j += 1
-            else:
-                j += int(letter)
-    # 14 ~ 28 for last state
+    # 0 ~ 14 for current state, 14 ~ 28 for last state
     # history = [...,last state, red action, black state, black action, current state]
-    if history and len(history) >= 5:
-        last_state = history[-5]
-        # logger.debug(f"last state = {last_state}")
-        rows = last_state.split('/')
-        for i in range(len(rows)):
-            row = rows[i]
-            j = 0
-            for letter in row:
-                if letter.isalpha():
-                    # 0 ~ 7 : upper, 7 ~ 14: lower
-                    planes[Fen_2_Idx[letter] + int(letter.islower()) * 7 + 14][i][j] = 1
-                    j += 1
-                else:
-                    j += int(letter)
-    return planes
+    last_state = history[-5] if history and len(history) >= 5 else None
+    return states_to_planes([state], [last_state])[0]
+
+def states_to_planes(states, last_states=None, out=None):
+    '''
+    Encode a list of states in one shot: N x 14 x 10 x 9, or N x 28 x 10 x 9 with the
+    states two plies back in `last_states` (None where there is no such state).
+    `out` is an optional preallocated array with at least N rows
+    '''
+    codes = states_to_arrays(states)
+    last_codes = None
+    if last_states is not None:
+        last_codes = np.zeros_like(codes)
+        rows = [i for i, last_state in enumerate(last_states) if last_state]
+        if rows:
+            last_codes[rows] = states_to_arrays([last_states[i] for i in rows])
+    return arrays_to_planes(codes, last_codes, out)
+
+def states_to_arrays(states):
+    '''
+    N x 90 compact boards (uint8) of a list of states
+    '''
+    boards = b''.join(state_to_array(state) for state in states)
+    return np.frombuffer(boards, dtype=np.uint8).reshape(len(states), 90)
+
+def arrays_to_planes(codes, last_codes=None, out=None):
+    '''
+    Same as states_to_planes for N x 90 compact boards
+    '''
+    n = len(codes)
+    depth = 14 if last_codes is None else 28
+    if out is None:
+        out = np.zeros(shape=(n, depth, 10, 9), dtype=np.float32)
+    else:
+        out = out[:n]
+        out.fill(0)
+    flat = out.reshape(n, depth, 90)
+    _fill_planes(codes, flat[:, :14])
+    if last_codes is not None:
+        _fill_planes(last_codes, flat[:, 14:])
+    return out
+
+def _fill_planes(codes, flat):
+    # codes: N x 90 boards, flat: zeroed N x 14 x 90 planes
+    rows, squares = np.nonzero(codes)
+    flat[rows, Code_2_Plane[codes[rows, squares]], squares] = 1
 
 def board_to_state(board):
     c = 0
@@ -243,82 +444,84 @@ def flip_fen(fen):
         + " " + foo[3] + " " + foo[4] + " " + foo[5]
 
 def fliped_state(state):
-    rows = state.split('/')
-    def swapcase(a):
-        if a.isalpha():
-            return a.lower() if a.isupper() else a.upper()
-        return a
-    def swapall(aa):
-        return "".join([swapcase(a) for a in aa])
+    # reversing the string reverses both the rows and each row
+    return state[::-1].swapcase()
+
+def mirror_state(state):
+    # left-right reflection: reverse every row
+    return '/'.join(row[::-1] for row in state.split('/'))
 
-    return "/".join([swapall(reversed(row)) for row in reversed(rows)])
+def mirror_arrays(codes):
+    '''
+    Left-right mirror of N x 90 compact boards
+    '''
+    return np.ascontiguousarray(codes.reshape(-1, BOARD_HEIGHT, BOARD_WIDTH)[:, :, ::-1]).reshape(-1, 90)
+
+def mirror_planes(planes):
+    '''
+    Planes of the left-right mirrored state, works on a batch of planes too
+    '''
+    return planes[..., ::-1]
 
 def get_legal_moves(state, board=None):
-    board = board if board is not None else state_to_board(state)
-    legal_moves = []
-    for y in range(BOARD_HEIGHT):
-        for x in range(BOARD_WIDTH):
-            ch = board[y][x]
-            if not ch.islower():
-                continue
-            if ch in mov_dir:
-                for d in mov_dir[ch]:
-                    x_ = x + d[0]
-                    y_ = y + d[1]
-                    if not can_move(board, x_, y_):
-                        continue
-                    elif ch == 'p' and y < 5 and x_ != x:  # for red pawn
-                        continue
-                    elif ch == 'n' or ch == 'b' : # for knight and bishop
-                        if board[y+int(d[1]/2)][x+int(d[0]/2)] != '.':
-                            continue
-                        elif ch == 'b' and y_ > 4:
-                            continue
-                    elif ch == 'k' or ch == 'a': # for king and advisor
-                        if x_ < 3 or x_ > 5:
-                            continue
-                        if y_ > 2:
-                            continue
-                    legal_moves.append(move_to_str(x, y, x_, y_))
-                    if (ch == 'k'): #for King to King check
-                        d, u = y_board_from(board, x, y)
-                        if (u < BOARD_HEIGHT and board[u][x] == 'K'):
-                            legal_moves.append(move_to_str(x, y, x, u))
-
-            elif ch == 'r' or ch == 'c': # for connon and rook
-                l,r = x_board_from(board,x,y)
-                d,u = y_board_from(board,x,y)
-                for x_ in range(l+1,x):
-                    legal_moves.append(move_to_str(x, y, x_, y))
-                for x_ in range(x+1,r):
-                    legal_moves.append(move_to_str(x, y, x_, y))
-                for y_ in range(d+1,y):
-                    legal_moves.append(move_to_str(x, y, x, y_))
-                for y_ in range(y+1,u):
-                    legal_moves.append(move_to_str(x, y, x, y_))
-                if ch == 'r': # for rook
-                    if can_move(board, l, y):
-                        legal_moves.append(move_to_str(x, y, l, y))
-                    if can_move(board, r, y):
-                        legal_moves.append(move_to_str(x, y, r, y))
-                    if can_move(board, x, d):
-                        legal_moves.append(move_to_str(x, y, x, d))
-                    if can_move(board, x, u):
-                        legal_moves.append(move_to_str(x, y, x, u))
-                else: # for connon
-                    l_, _ = x_board_from(board, l,y)
-                    _, r_ = x_board_from(board, r,y)
-                    d_, _ = y_board_from(board, x,d)
-                    _, u_ = y_board_from(board, x,u)
-                    if can_move(board, l_, y):
-                        legal_moves.append(move_to_str(x, y, l_, y))
-                    if can_move(board, r_, y):
-                        legal_moves.append(move_to_str(x, y, r_, y))
-                    if can_move(board, x, d_):
-                        legal_moves.append(move_to_str(x, y, x, d_))
-                    if can_move(board, x, u_):
-                        legal_moves.append(move_to_str(x, y, x, u_))
-    return legal_moves
+    '''
+    Legal moves of the side to move, `board` may be a compact board (see state_to_array)
+    '''
+    if not isinstance(board, bytearray):
+        board = state_to_array(state)
+    return [Code_2_Move[code] for code in generate_moves(board)]
+
+def get_legal_labels(state, board=None):
+    '''
+    Legal moves of the side to move as an int array of ActionLabelsRed indices
+    '''
+    if not isinstance(board, bytearray):
+        board = state_to_array(state)
+    return Code_2_Label[generate_moves(board)]
+
+def generate_moves(board):
+    '''
+    Legal moves of the side to move on a compact board, as move codes (from * 90 + to)
+    '''
+    moves = []
+    append = moves.append
+    for sq in _SCAN_ORDER:
+        piece = board[sq]
+        if piece == EMPTY or piece > OPPONENT:
+            continue
+        base = sq * 90
+        if piece == ROOK_CODE or piece == CANNON_CODE:
+            captures = []
+            for i, ray in enumerate(Ray_Table[sq]):
+                n = len(ray)
+                k = 0
+                while k < n and board[ray[k]] == EMPTY:
+                    k += 1
+                # left and down are listed far to near
+                for to in (reversed(ray[:k]) if i % 2 == 0 else ray[:k]):
+                    append(base + to)
+                if piece == CANNON_CODE:
+                    k += 1
+                    while k < n and board[ray[k]] == EMPTY:
+                        k += 1
+                if k < n and board[ray[k]] > OPPONENT:
+                    captures.append(base + ray[k])
+            moves.extend(captures)
+        elif piece == KNIGHT_CODE or piece == ELEPHANT_CODE:
+            for to, leg in (Knight_Table[sq] if piece == KNIGHT_CODE else Elephant_Table[sq]):
+                if board[leg] == EMPTY and (board[to] == EMPTY or board[to] > OPPONENT):
+                    append(base + to)
+        else:
+            for to in Step_Tables[piece][sq]:
+                if board[to] == EMPTY or board[to] > OPPONENT:
+                    append(base + to)
+            if piece == KING_CODE:  # for King to King check
+                for to in Ray_Table[sq][3]:
+                    if board[to] != EMPTY:
+                        if board[to] == KING_CODE + OPPONENT:
+                            append(base + to)
+                        break
+    return moves
 
 def can_move(board, x, y): # basically check the move
     if x < 0 or x > BOARD_WIDTH-1:
@@ -391,82 +594,199 @@ def will_check_or_catch(ori_state, action):
     '''
     判断走了下一步是否会造成红方将军或捉子
     '''
-    state = step(ori_state, action)     # 判断当前state的红方是否会被将/捉
-    board = state_to_board(state)
+    board = state_to_array(ori_state)
+    src, dst = Move_2_Sq[action]
+    after = bytearray(board)    # still seen from the side that moves
+    after[dst] = after[src]
+    after[src] = EMPTY
     # permanent check
-    red_k = [0, 0]
-    for i in range(BOARD_HEIGHT):
-        for j in range(BOARD_WIDTH):
-            if board[i][j] == 'k':
-                red_k[0] = i
-                red_k[1] = j
-    black_state = fliped_state(state)
-    black_moves = get_legal_moves(black_state)
-    # render(black_state)
-    red_k[0] = 9 - red_k[0]
-    red_k[1] = 8 - red_k[1]
-    for mov in black_moves:
-        dest = [int(mov[3]), int(mov[2])]
-        if dest == red_k:
-            check = True
-            # logger.debug(f"Checking move {mov}")
-            return True
-    # permanent catch
-    first_set = get_catch_list(ori_state)
-    second_set = get_catch_list(black_state, black_moves)
-    if second_set - first_set != set() and len(second_set) >= len(first_set):
-        # logger.debug(f"Permanent catch, first_set = {first_set}, second_set = {second_set}")
+    opp_king = after.find(KING_CODE + OPPONENT)
+    if opp_king >= 0 and attackers(after, opp_king):
         return True
-    else:
-        return False
+    # permanent catch
+    first_set = get_catch_list(board)
+    second_set = get_catch_list(after)
+    return second_set - first_set != set() and len(second_set) >= len(first_set)
+
+# letters of the pieces in the catch lists, as in state_to_board
+_CATCH_CHARS = [state_to_board_dict[c].swapcase() if c in state_to_board_dict else '.' for c in _STATE_CHARS.decode()]
+
+# compact board -> attack maps / catch list, cleared when full
+_Attack_Cache = {}
+_Catch_Cache = {}
+Chase_Cache_Size = 1 << 12
+
+def _attack_counts(board):
+    '''
+    Number of pieces of the side to move attacking each square (as in attackers)
+    '''
+    counts = [0] * 90
+    for sq in range(90):
+        piece = board[sq]
+        if piece == EMPTY or piece > OPPONENT:
+            continue
+        if piece == ROOK_CODE or piece == CANNON_CODE:
+            for ray in Ray_Table[sq]:
+                # rooks attack up to the first piece, cannons from behind it up to the next one
+                jumped = piece == ROOK_CODE
+                for to in ray:
+                    if jumped:
+                        counts[to] += 1
+                        if board[to] != EMPTY:
+                            break
+                    elif board[to] != EMPTY:
+                        jumped = True
+        elif piece == KNIGHT_CODE or piece == ELEPHANT_CODE:
+            for to, leg in (Knight_Table[sq] if piece == KNIGHT_CODE else Elephant_Table[sq]):
+                if board[leg] == EMPTY:
+                    counts[to] += 1
+        else:
+            for to in Step_Tables[piece][sq]:
+                counts[to] += 1
+            if piece == KING_CODE:
+                for to in Ray_Table[sq][3]:
+                    if board[to] != EMPTY:
+                        if board[to] == KING_CODE + OPPONENT:
+                            counts[to] += 1
+                        break
+    return counts
+
+def attack_maps(board):
+    '''
+    Attack counts of both sides on a compact board: (side to move, opponent), two lists
+    of 90 counts in the coordinates of the side to move. A count on a square occupied by
+    the same side is the number of its defenders. Cached per board.
+    '''
+    cache_key = bytes(board)
+    maps = _Attack_Cache.get(cache_key)
+    if maps is None:
+        maps = (_attack_counts(board), _attack_counts(board[::-1].translate(_SWAP_SIDE))[::-1])
+        if len(_Attack_Cache) >= Chase_Cache_Size:
+            _Attack_Cache.clear()
+        _Attack_Cache[cache_key] = maps
+    return maps
 
 def get_catch_list(state, moves=None):
-    catch_list = set()
-    if not moves:
-        moves = get_legal_moves(state)
-    for mov in moves:
-        next_state, no_eat = new_step(state, mov)
-        if not no_eat:  # 有吃子
-            # 判断能不能吃回来(防御)
-            could_defend = False
-            next_moves = get_legal_moves(next_state)
-            fliped_move = flip_move(mov)
-            dest = fliped_move[2:]
-            for nmov in next_moves:
-                if nmov[2:] == dest:
-                    could_defend = True
-                    break
-            if not could_defend:
-                i = int(mov[1])
-                j = int(mov[0])
-                black_board = state_to_board(state)
-                if black_board[i][j] == 'p' and i <= 4:
-                    continue
-                m = int(mov[3])
-                n = int(mov[2])
-                if black_board[m][n] == 'P' and m > 4:
-                    continue
-                # 判断是否为兑
-                if black_board[m][n].upper() == black_board[i][j].upper():
-                    continue
-                # print(f"Catch: mov = {mov}, chessman = {black_board[i][j]}")
-                catch_list.add((black_board[i][j], i, j, black_board[m][n], m, n))
-    return catch_list
+    '''
+    Pieces the side to move can catch: captures of undefended pieces, except exchanges and
+    captures by or of pawns that have not crossed the river. `state` may be a compact board,
+    `moves` is not needed any more. Entries are (piece, y, x, captured, y, x).
+    '''
+    board = state if isinstance(state, bytearray) else state_to_array(state)
+    cache_key = bytes(board)
+    catches = _Catch_Cache.get(cache_key)
+    if catches is None:
+        catches = frozenset(_catch_list(board))
+        if len(_Catch_Cache) >= Chase_Cache_Size:
+            _Catch_Cache.clear()
+        _Catch_Cache[cache_key] = catches
+    return set(catches)
+
+def _catch_list(board):
+    mine, _ = attack_maps(board)
+    catches = []
+    for dst in range(90):
+        captured = board[dst]
+        if captured <= OPPONENT or not mine[dst]:
+            continue
+        m, n = BOARD_HEIGHT - 1 - dst // BOARD_WIDTH, dst % BOARD_WIDTH
+        if captured == PAWN_CODE + OPPONENT and m > 4:
+            continue
+        for src in attackers(board, dst):
+            piece = board[src]
+            i, j = BOARD_HEIGHT - 1 - src // BOARD_WIDTH, src % BOARD_WIDTH
+            if (piece == PAWN_CODE and i <= 4) or piece == captured - OPPONENT:
+                continue
+            # 判断能不能吃回来(防御): can the opponent take back on dst after the capture
+            after = bytearray(board)
+            after[dst] = piece
+            after[src] = EMPTY
+            if attackers(after[::-1].translate(_SWAP_SIDE), 89 - dst):
+                continue
+            catches.append((_CATCH_CHARS[piece], i, j, _CATCH_CHARS[captured], m, n))
+    return catches
 
 def be_catched(state, mov):
-    i = int(mov[1])
-    j = int(mov[0])
-    position = [i, j]
-    board = state_to_board(state)
-    black_state = fliped_state(state)
-    black_moves = get_legal_moves(black_state)
-    position[0] = 9 - position[0]
-    position[1] = 8 - position[1]
-    for mov in black_moves:
-        dest = [int(mov[3]), int(mov[2])]
-        if dest == position:
-            return True
-    return False
+    '''
+    Whether the piece moved by `mov` is attacked by the opponent before the move
+    '''
+    return attack_maps(state_to_array(state))[1][Move_2_Sq[mov][0]] > 0
+
+# (position key, move) -> verdict of repetition_verdict, cleared when full
+_Verdict_Cache = {}
+Verdict_Cache_Size = 1 << 16
+
+def repetition_verdict(key, move, state):
+    '''
+    Verdict on playing `move` again at a repeated position, memoized by (key, move):
+    -1 if the move checks or catches (not allowed), 1 if it escapes from being caught, 0 otherwise.
+    `state` is the state string or a Position, only read on a cache miss
+    '''
+    verdict = _Verdict_Cache.get((key, move))
+    if verdict is None:
+        if isinstance(state, Position):
+            state = state.state
+        if will_check_or_catch(state, move):
+            verdict = -1
+        elif be_catched(state, move):
+            verdict = 1
+        else:
+            verdict = 0
+        if len(_Verdict_Cache) >= Verdict_Cache_Size:
+            _Verdict_Cache.clear()
+        _Verdict_Cache[(key, move)] = verdict
+    return verdict
+
+class RepetitionTracker:
+    '''
+    Positions of a game keyed by Zobrist key: how many times each occurred, the ply of its
+    first occurrence and the moves played from it, so repetitions are found without scanning
+    the history. `history` is an optional [state, move, state, ...] list to start from.
+    '''
+    def __init__(self, history=None):
+        self.keys = []          # key of each position, in order
+        self.count = {}         # key -> occurrences
+        self.first = {}         # key -> index in keys of the first occurrence
+        self.moves = {}         # key -> moves played from the position, in order
+        if history:
+            self.push(state_key(history[0]))
+            for i in range(1, len(history) - 1, 2):
+                self.play(history[i])
+                self.push(state_key(history[i + 1]))
+
+    def push(self, key):
+        '''
+        Record the position reached
+        '''
+        self.count[key] = self.count.get(key, 0) + 1
+        if key not in self.first:
+            self.first[key] = len(self.keys)
+        self.keys.append(key)
+
+    def play(self, move):
+        '''
+        Record the move played from the last position
+        '''
+        self.moves.setdefault(self.keys[-1], []).append(move)
+
+    def repeated(self, key=None):
+        '''
+        Whether the (last) position occurred before
+        '''
+        return self.count.get(self.keys[-1] if key is None else key, 0) > 1
+
+    def previous_moves(self, key=None):
+        '''
+        Moves played from the earlier occurrences of the (last) position
+        '''
+        return self.moves.get(self.keys[-1] if key is None else key, [])
+
+    def verdicts(self, state, key=None):
+        '''
+        (move, repetition_verdict) of each move played from the earlier occurrences of the (last) position
+        '''
+        key = self.keys[-1] if key is None else key
+        return [(move, repetition_verdict(key, move, state)) for move in self.previous_moves(key)]
 
 def has_attack_chessman(state):
     '''
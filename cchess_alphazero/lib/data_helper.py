@@ -1,17 +1,41 @@
 import os
 import json
+import shutil
+import struct
+import numpy as np
+from contextlib import contextmanager
 from datetime import datetime
 from glob import glob
 from logging import getLogger
+from threading import RLock
+from time import time
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
 
 from cchess_alphazero.config import ResourceConfig
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Move_2_Idx
 
 logger = getLogger(__name__)
 
+# Binary game container: GAME_FILE_MAGIC followed by appended game records, each record is
+#   uint32 size of the rest of the record
+#   uint16 number of moves n, uint8 flags, uint8 length of the initial state, initial state (ascii)
+#   uint16[n] moves (index of ActionLabelsRed), int8[n] values
+#   if flags & HAS_VISITS: uint8[n] number of visit entries k_i, then sum(k_i) x (uint16 label, uint16 visits)
+# A game in memory is the same list as in the JSON files: [state, [move, value], ...], a move item
+# may carry the visit counts of the search as a third element: [move, value, [[label, visits], ...]]
+GAME_FILE_MAGIC = b'CCGD\x01'
+HAS_VISITS = 1
+_HEADER = struct.Struct('<IHBB')
+
 def get_game_data_filenames(rc: ResourceConfig):
     pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
+    bin_pattern = os.path.join(rc.play_data_dir, rc.play_data_bin_filename_tmpl % "*")
     # files = list(sorted(glob(pattern), key=get_key))
-    files = list(sorted(glob(pattern)))
+    files = list(sorted(glob(pattern) + glob(bin_pattern)))
     return files
 
 def write_game_data_to_file(path, data):
@@ -20,9 +44,312 @@ def write_game_data_to_file(path, data):
 
 
 def read_game_data_from_file(path):
+    '''
+    Return the data of a JSON or binary game file, games are concatenated
+    '''
+    if is_binary_game_file(path):
+        data = []
+        for game in read_games_from_file(path):
+            data += game
+        return data
     with open(path, "rt") as f:
         return json.load(f)
 
 def get_key(x):
     stat_x = os.stat(x) 
     return stat_x.st_ctime
+
+def is_binary_game_file(path):
+    return path.endswith('.bin')
+
+def split_games(data):
+    '''
+    Split concatenated game data at the initial states
+    '''
+    games = []
+    for item in data:
+        if isinstance(item, str):
+            games.append([item])
+        elif games:
+            games[-1].append(item)
+    return games
+
+def encode_game(game):
+    state = game[0].encode('ascii')
+    items = game[1:]
+    moves = np.array([Move_2_Idx[item[0]] for item in items], dtype='<u2')
+    values = np.array([round(item[1]) for item in items], dtype=np.int8)
+    flags = HAS_VISITS if any(len(item) > 2 for item in items) else 0
+    body = [state, moves.tobytes(), values.tobytes()]
+    if flags & HAS_VISITS:
+        visits = [item[2] if len(item) > 2 else [] for item in items]
+        lengths = np.array([len(v) for v in visits], dtype=np.int64)
+        pairs = np.array([x for v in visits for x in v], dtype=np.int64).reshape(-1, 2)
+        # stored as uint8 and uint16, out of range values would wrap around silently
+        if lengths.max() > 255:
+            raise ValueError(f"{lengths.max()} visit counts for one move, at most 255 can be stored")
+        if pairs.size and (pairs.min() < 0 or pairs.max() > 65535):
+            raise ValueError(f"Visit labels and counts must be in 0..65535, got {pairs.min()}..{pairs.max()}")
+        body.append(lengths.astype(np.uint8).tobytes())
+        body.append(pairs.astype('<u2').tobytes())
+    body = b''.join(body)
+    return _HEADER.pack(_HEADER.size - 4 + len(body), len(items), flags, len(state)) + body
+
+def decode_game(buf, offset=0):
+    '''
+    Decode the record at `offset`, return (game, offset of the next record)
+    '''
+    size, n, flags, state_len = _HEADER.unpack_from(buf, offset)
+    end = offset + 4 + size
+    pos = offset + _HEADER.size
+    game = [bytes(buf[pos:pos + state_len]).decode('ascii')]
+    pos += state_len
+    moves = np.frombuffer(buf, dtype='<u2', count=n, offset=pos)
+    pos += 2 * n
+    values = np.frombuffer(buf, dtype=np.int8, count=n, offset=pos)
+    pos += n
+    visits = None
+    if flags & HAS_VISITS:
+        counts = np.frombuffer(buf, dtype=np.uint8, count=n, offset=pos)
+        pos += n
+        pairs = np.frombuffer(buf, dtype='<u2', count=2 * int(counts.sum()), offset=pos).reshape(-1, 2)
+        bounds = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        visits = [pairs[bounds[i]:bounds[i + 1]].tolist() for i in range(n)]
+    for i in range(n):
+        item = [ActionLabelsRed[moves[i]], int(values[i])]
+        if visits is not None:
+            item.append(visits[i])
+        game.append(item)
+    return game, end
+
+def append_games_to_file(path, games):
+    '''
+    Append games to a binary container, the file is created if needed
+    '''
+    records = b''.join(encode_game(game) for game in games)
+    with open(path, "ab") as f:
+        if f.tell() == 0:
+            f.write(GAME_FILE_MAGIC)
+        f.write(records)
+
+def read_games_from_file(path):
+    with open(path, "rb") as f:
+        buf = f.read()
+    if not buf.startswith(GAME_FILE_MAGIC):
+        raise ValueError(f"{path} is not a game data file")
+    games = []
+    offset = len(GAME_FILE_MAGIC)
+    while offset + 4 <= len(buf):
+        if offset + 4 + struct.unpack_from('<I', buf, offset)[0] > len(buf):
+            logger.error(f"Truncated game record in {path}")
+            break
+        game, offset = decode_game(buf, offset)
+        games.append(game)
+    return games
+
+def convert_game_data_files(rc: ResourceConfig, games_per_file=250):
+    '''
+    Convert the JSON files in play_data into binary containers, the JSON files are moved to data/converted
+    '''
+    pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % "*")
+    files = list(sorted(glob(pattern)))
+    backup_folder = os.path.join(rc.data_dir, 'converted')
+    if not os.path.exists(backup_folder):
+        os.makedirs(backup_folder)
+    manifest = GameManifest(rc)
+    for i in range(0, len(files), games_per_file):
+        games, done = [], []
+        for filename in files[i:i + games_per_file]:
+            try:
+                games += split_games(read_game_data_from_file(filename))
+                done.append(filename)
+            except Exception as e:
+                logger.error(f"Skip {filename}: {e}")
+        if not games:
+            continue
+        prefix, suffix = rc.play_data_filename_tmpl.split("%s")
+        game_id = os.path.basename(done[-1])[len(prefix):-len(suffix)]
+        path = os.path.join(rc.play_data_dir, rc.play_data_bin_filename_tmpl % game_id)
+        append_games_to_file(path, games)
+        for filename in done:
+            shutil.move(filename, backup_folder)
+        manifest.add(path, len(games))
+        manifest.remove(done)
+        logger.info(f"Convert {len(done)} files ({len(games)} games) to {path}")
+
+class GameManifest:
+    '''
+    Append-only index of the game files in play_data (rc.play_data_manifest), one JSON line per change:
+    {"add": name, "games": n, "bytes": size} or {"remove": name}. Writers append under a file lock,
+    readers tail the new lines in `refresh` instead of listing the directory. The directory is
+    only scanned by `sync` (at most every `sync_interval` seconds) to pick up files written by
+    other tools, which is also how the manifest is built the first time.
+    '''
+    def __init__(self, rc: ResourceConfig, sync_interval=600):
+        self.rc = rc
+        self.path = rc.play_data_manifest
+        self.sync_interval = sync_interval
+        self.last_sync = 0
+        self.lock = RLock()
+        self.reset()
+        self.refresh()
+
+    def reset(self):
+        self.names = []         # file names in order of addition, removed ones included
+        self.index = {}         # name -> position in names
+        self.live = {}          # name -> [games (None if unknown), bytes] of the files in play_data
+        self.n_bytes = 0
+        self.n_lines = 0
+        self.offset = 0
+        self.inode = None
+
+    def __len__(self):
+        return len(self.live)
+
+    def n_games(self):
+        return sum(games for games, _ in self.live.values() if games)
+
+    @contextmanager
+    def locked(self):
+        with open(self.path + '.lock', 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write(self, entries):
+        if not entries:
+            return
+        data = ''.join(json.dumps(entry) + '\n' for entry in entries).encode()
+        with self.locked():
+            with open(self.path, 'ab') as f:
+                f.write(data)
+
+    def add(self, path, games=None):
+        self.write([{'add': os.path.basename(path), 'games': games, 'bytes': os.path.getsize(path)}])
+
+    def remove(self, paths):
+        self.write([{'remove': os.path.basename(path)} for path in paths])
+
+    def apply(self, entry):
+        self.n_lines += 1
+        if 'remove' in entry:
+            old = self.live.pop(entry['remove'], None)
+            if old is not None:
+                self.n_bytes -= old[1]
+            return
+        name = entry['add']
+        old = self.live.get(name)
+        if old is None:
+            # a new file (or a removed one written again) goes to the end
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        else:
+            self.n_bytes -= old[1]
+        games = entry.get('games')
+        if games is None and old is not None:
+            games = old[0]
+        self.live[name] = [games, entry.get('bytes', 0)]
+        self.n_bytes += self.live[name][1]
+
+    def refresh(self):
+        '''
+        Read the lines appended since the last call, and sync with the directory when it is due
+        '''
+        with self.lock:
+            if not self.tail() or time() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def tail(self):
+        '''
+        Apply the lines appended since the last read, return False if there is no manifest yet
+        '''
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # first read or the manifest was compacted
+            self.reset()
+            self.inode = st.st_ino
+        if st.st_size > self.offset:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                chunk = f.read(st.st_size - self.offset)
+            end = chunk.rfind(b'\n') + 1
+            for line in chunk[:end].splitlines():
+                self.apply(json.loads(line))
+            self.offset += end
+        return True
+
+    def sync(self):
+        '''
+        Reconcile the manifest with a scan of play_data
+        '''
+        with self.lock:
+            self.last_sync = time()
+            files = get_game_data_filenames(self.rc)
+            names = set(os.path.basename(path) for path in files)
+            entries = [{'remove': name} for name in self.live if name not in names]
+            for path in files:
+                if os.path.basename(path) not in self.live:
+                    try:
+                        entries.append({'add': os.path.basename(path), 'games': None, 'bytes': os.path.getsize(path)})
+                    except OSError:
+                        pass
+            if entries:
+                logger.debug(f"Sync game data manifest: {len(entries)} changes")
+                self.write(entries)
+                self.tail()
+
+    def filenames(self, after=None):
+        '''
+        Paths of the files in play_data in order of addition, only those added after `after` if given
+        '''
+        with self.lock:
+            after = os.path.basename(after) if after else None
+            start = self.index[after] + 1 if after in self.index else 0
+            return [os.path.join(self.rc.play_data_dir, self.names[i]) for i in range(start, len(self.names))
+                    if self.names[i] in self.live and self.index[self.names[i]] == i]
+
+    def retain(self, max_files, max_bytes=0):
+        '''
+        Delete the oldest files until at most `max_files` files (and `max_bytes` bytes if set) are left
+        '''
+        with self.lock:
+            self.refresh()
+            n, size = len(self.live), self.n_bytes
+            if n <= max_files and (not max_bytes or size <= max_bytes):
+                return
+            removed = []
+            for path in self.filenames():
+                if n <= max_files and (not max_bytes or size <= max_bytes):
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                removed.append(path)
+                n -= 1
+                size -= self.live[os.path.basename(path)][1]
+            self.remove(removed)
+            self.tail()
+            if self.n_lines > 4 * len(self.live) + 1000:
+                self.compact()
+
+    def compact(self):
+        '''
+        Rewrite the manifest with only the files still in play_data
+        '''
+        with self.lock, self.locked():
+            self.tail()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wt') as f:
+                for path in self.filenames():
+                    games, size = self.live[os.path.basename(path)]
+                    f.write(json.dumps({'add': os.path.basename(path), 'games': games, 'bytes': size}) + '\n')
+            os.replace(tmp, self.path)
+            self.tail()
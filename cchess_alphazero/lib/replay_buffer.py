@@ -0,0 +1,139 @@
+import os
+import json
+import numpy as np
+from logging import getLogger
+
+import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.environment.lookup_tables import densify_policy
+
+logger = getLogger(__name__)
+
+class ReplayBuffer:
+    '''
+    Ring buffer of training positions kept in memory-mapped files under `path`.
+    A position is stored compactly: its board as 90 piece codes (and the board two plies back
+    if `use_history`), the policy as up to `policy_k` (label, probability) pairs and the value.
+    Float planes and dense policies are only built for each mini-batch.
+    '''
+    def __init__(self, path, capacity, use_history=False, policy_k=1):
+        self.path = path
+        self.capacity = capacity
+        self.use_history = use_history
+        self.policy_k = policy_k
+        self.head = 0
+        self.size = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+        meta = self.load_meta()
+        mode = 'r+' if meta is not None else 'w+'
+        self.last_boards = None
+        for name, dtype, shape in self.arrays():
+            setattr(self, name, self.open_array(name, dtype, shape, mode))
+        if meta is not None:
+            self.head, self.size = meta['head'], meta['size']
+            logger.info(f"Load replay buffer with {self.size} positions from {path}")
+
+    def meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def load_meta(self):
+        if not os.path.exists(self.meta_path()):
+            return None
+        with open(self.meta_path(), 'rt') as f:
+            meta = json.load(f)
+        if meta['capacity'] != self.capacity or meta['use_history'] != self.use_history \
+            or meta['policy_k'] != self.policy_k:
+            logger.info(f"Replay buffer settings changed, discard the old buffer in {self.path}")
+            return None
+        for name, dtype, shape in self.arrays():
+            path = os.path.join(self.path, name + '.dat')
+            if not os.path.exists(path) or os.path.getsize(path) != np.dtype(dtype).itemsize * int(np.prod(shape)):
+                logger.info(f"Replay buffer file {path} is missing or truncated, discard the old buffer")
+                return None
+        return meta
+
+    def arrays(self):
+        '''
+        (name, dtype, shape) of the backing files
+        '''
+        arrays = [('boards', np.uint8, (self.capacity, 90))]
+        if self.use_history:
+            arrays.append(('last_boards', np.uint8, (self.capacity, 90)))
+        return arrays + [('policy_idx', np.int16, (self.capacity, self.policy_k)),
+                         ('policy_p', np.float32, (self.capacity, self.policy_k)),
+                         ('values', np.float32, (self.capacity,))]
+
+    def open_array(self, name, dtype, shape, mode):
+        return np.memmap(os.path.join(self.path, name + '.dat'), dtype=dtype, mode=mode, shape=shape)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, boards, last_boards, policy_idx, policy_p, values):
+        '''
+        Append positions (the oldest ones are overwritten once the buffer is full)
+        '''
+        n = len(values)
+        if n > self.capacity:
+            boards, policy_idx, policy_p, values = boards[-self.capacity:], policy_idx[-self.capacity:], \
+                                                   policy_p[-self.capacity:], values[-self.capacity:]
+            last_boards = last_boards[-self.capacity:] if last_boards is not None else None
+            n = self.capacity
+        k = min(policy_idx.shape[1], self.policy_k)
+        if k < policy_idx.shape[1]:
+            # keep the most probable moves
+            order = np.argsort(-policy_p, axis=1)[:, :k]
+            policy_idx = np.take_along_axis(policy_idx, order, axis=1)
+            policy_p = np.take_along_axis(policy_p, order, axis=1)
+            # the kept moves get the probability of the dropped ones
+            total = policy_p.sum(axis=1, keepdims=True)
+            policy_p = policy_p / np.where(total > 0, total, 1)
+        rows = (self.head + np.arange(n)) % self.capacity
+        self.boards[rows] = boards
+        if self.use_history:
+            self.last_boards[rows] = last_boards if last_boards is not None else 0
+        self.policy_idx[rows] = 0
+        self.policy_p[rows] = 0
+        self.policy_idx[rows, :k] = policy_idx
+        self.policy_p[rows, :k] = policy_p
+        self.values[rows] = values
+        self.head = int((self.head + n) % self.capacity)
+        self.size = min(self.size + n, self.capacity)
+
+    def flush(self):
+        for ary in (self.boards, self.last_boards, self.policy_idx, self.policy_p, self.values):
+            if ary is not None:
+                ary.flush()
+        with open(self.meta_path(), 'wt') as f:
+            json.dump({'capacity': self.capacity, 'use_history': self.use_history, 'policy_k': self.policy_k,
+                       'head': self.head, 'size': self.size}, f)
+
+    def get_batch(self, rows):
+        '''
+        Planes, dense policies and values of the positions in `rows`
+        '''
+        last_boards = self.last_boards[rows] if self.use_history else None
+        planes = senv.arrays_to_planes(self.boards[rows], last_boards)
+        policy = densify_policy(self.policy_idx[rows], self.policy_p[rows])
+        return planes, policy, np.asarray(self.values[rows])
+
+    def generator(self, batch_size):
+        '''
+        Endless mini-batches sampled uniformly from the buffer, in the form of Keras fit_generator
+        '''
+        while True:
+            rows = np.sort(np.random.randint(0, self.size, size=batch_size))
+            planes, policy, values = self.get_batch(rows)
+            yield planes, [policy, values]
+
+def sparse_batches(state_ary, policy_idx, policy_p, value_ary, batch_size):
+    '''
+    Endless shuffled mini-batches of in-memory data with sparse policy targets, the policies
+    are densified per batch (fit_generator form, one epoch = ceil(N / batch_size) batches)
+    '''
+    n = len(state_ary)
+    while True:
+        order = np.random.permutation(n)
+        for i in range(0, n, batch_size):
+            rows = np.sort(order[i:i + batch_size])
+            yield state_ary[rows], [densify_policy(policy_idx[rows], policy_p[rows]), value_ary[rows]]
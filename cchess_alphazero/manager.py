@@ -8,7 +8,7 @@ from cchess_alphazero.config import Config, PlayWithHumanConfig
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob']
+CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob', 'convert', 'perft', 'bench']
 PIECE_STYLE_LIST = ['WOOD', 'POLISH', 'DELICATE']
 BG_STYLE_LIST = ['CANVAS', 'DROPS', 'GREEN', 'QIANHONG', 'SHEET', 'SKELETON', 'WHITE', 'WOOD']
 RANDOM_LIST = ['none', 'small', 'medium', 'large']
@@ -30,6 +30,9 @@ def create_parser():
     parser.add_argument("--random", help="choose a style of randomness", choices=RANDOM_LIST, default="none")
     parser.add_argument("--distributed", help="whether upload/download file from remote server", action="store_true")
     parser.add_argument("--elo", help="whether to compute elo score", action="store_true")
+    parser.add_argument("--depth", help="max depth of perft", default=3, type=int)
+    parser.add_argument("--prior", help="priors of the stub network of bench", choices=['random', 'uniform'], default='random')
+    parser.add_argument("--latency", help="latency in ms of each batch of the stub network of bench", default=0, type=float)
     return parser
 
 def setup(config: Config, args):
@@ -48,6 +51,8 @@ def setup(config: Config, args):
         setup_logger(config.resource.eval_log_path)
     elif args.cmd == 'sl':
         setup_logger(config.resource.sl_log_path)
+    elif args.cmd == 'convert':
+        setup_logger(config.resource.main_log_path)
 
 def start():
     parser = create_parser()
@@ -114,4 +119,13 @@ def start():
         pwhc = PlayWithHumanConfig()
         pwhc.update_play_config(config.play)
         ob_self_play.start(config, args.ucci, args.ai_move_first)
+    elif args.cmd == 'convert':
+        from cchess_alphazero.lib.data_helper import convert_game_data_files
+        convert_game_data_files(config.resource, config.play_data.sl_nb_game_in_file)
+    elif args.cmd == 'perft':
+        from cchess_alphazero.environment import perft
+        perft.start(args.depth)
+    elif args.cmd == 'bench':
+        from cchess_alphazero.worker import benchmark
+        benchmark.start(config, args.prior, args.latency)
         
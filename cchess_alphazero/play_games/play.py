@@ -17,7 +17,7 @@ import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.environment.chessboard import Chessboard
 from cchess_alphazero.environment.chessman import *
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, SearchTree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
@@ -99,7 +99,7 @@ class PlayWithHuman:
         self.env.reset()
         self.load_model()
         self.pipe = self.model.get_pipes()
-        self.ai = CChessPlayer(self.config, search_tree=defaultdict(VisitState), pipes=self.pipe,
+        self.ai = CChessPlayer(self.config, search_tree=SearchTree(self.config.play.max_tree_nodes), pipes=self.pipe,
                               enable_resign=True, debugging=True)
         self.human_move_first = human_first
 
@@ -223,7 +223,7 @@ class PlayWithHuman:
                 self.history.append(action)
                 if not self.env.red_to_move:
                     action = flip_move(action)
-                key = self.env.get_state()
+                key = senv.state_key(self.env.get_state())
                 p, v = self.ai.debug[key]
                 logger.info(f"check = {check}, NN value = {v:.3f}")
                 self.nn_value = v
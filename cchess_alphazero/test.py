@@ -326,7 +326,60 @@ def test_be_catched():
     print()
     action = '4454'
     print(senv.be_catched(ori_state, action))
-    
+
+def test_batch_max_size():
+    import threading
+    import numpy as np
+    from contextlib import contextmanager
+    from cchess_alphazero.config import Config
+    from cchess_alphazero.agent.api import CChessModelAPI
+    c = Config('mini')
+    c.play.batch_max_size = 16
+    c.play.batch_max_wait_us = 2000
+    c.play.eval_cache_size = 0
+    c.play.shared_memory_transport = False
+    sizes = []
+
+    class Model:
+        input_shape = (None, 14, 10, 9)
+        def predict_on_batch(self, data):
+            sizes.append(len(data))
+            # the value tells which request a state came from
+            return np.zeros((len(data), 2086), dtype=np.float32), data[:, 0, 0, :1].copy()
+
+    class AgentModel:
+        model = Model()
+        n_labels = 2086
+        digest = None
+        graph = None
+        @contextmanager
+        def as_default(self):
+            yield
+    agent_model = AgentModel()
+    agent_model.graph = agent_model
+
+    api = CChessModelAPI(c, agent_model)
+    pipes = [api.get_pipe(need_reload=False) for _ in range(4)]
+    api.start(need_reload=False)
+    errors = []
+
+    def player(i, pipe):
+        for j, n in enumerate([5, 12, 40, 16, 3, 9, 17, 1] * 5):
+            request_id = i * 1000 + j
+            pipe.send(np.full((n, 14, 10, 9), request_id, dtype=np.float32))
+            rets = pipe.recv()
+            if len(rets) != n or any(v != request_id for _, v in rets):
+                errors.append((request_id, n))
+    threads = [threading.Thread(target=player, args=(i, pipe)) for i, pipe in enumerate(pipes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    api.close()
+    assert not errors, errors
+    assert max(sizes) <= c.play.batch_max_size, max(sizes)
+    print(f"{len(sizes)} model calls, max size {max(sizes)}, mean size {np.mean(sizes):.1f}")
+
 
 if __name__ == "__main__":
     test_be_catched()
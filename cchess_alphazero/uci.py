@@ -28,7 +28,7 @@ sys.stderr = open(config.resource.play_log_path, 'a')
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, SearchTree
 from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_move
 from cchess_alphazero.lib.model_helper import load_model_weight
 from cchess_alphazero.lib.tf_util import set_session_config
@@ -47,7 +47,7 @@ class UCI:
         self.model = None
         self.pipe = None
         self.is_ready = False
-        self.search_tree = defaultdict(VisitState)
+        self.search_tree = SearchTree(self.config.play.max_tree_nodes)
         self.remain_time = None
         self.history = None
         self.turns = 0
@@ -91,7 +91,7 @@ class UCI:
         self.history = [self.state]
         self.is_ready = True
         self.is_red_turn = True
-        self.search_tree = defaultdict(VisitState)
+        self.search_tree = SearchTree(self.config.play.max_tree_nodes)
 
     def cmd_setoption(self):
         '''
@@ -203,7 +203,8 @@ class UCI:
         self.remain_time = None
         self.model.close_pipes()
         self.pipe = self.model.get_pipes(need_reload=False)
-        self.search_tree = defaultdict(VisitState)
+        carried = self.search_tree.prune(senv.Position(self.state))
+        logger.debug(f"reuse search tree: {len(self.search_tree)} nodes, {carried} visits")
         self.player = CChessPlayer(self.config, search_tree=self.search_tree, pipes=self.pipe,
                                     enable_resign=False, debugging=True, uci=True, 
                                     use_history=self.use_history, side=self.turns % 2)
@@ -240,13 +241,13 @@ class UCI:
             return
         if self.player:
             no_act = None
-            if self.state in self.history[:-1]:
-                no_act = []
-                for i in range(len(self.history) - 1):
-                    if self.history[i] == self.state:
-                        no_act.append(self.history[i + 1])
+            repetition = senv.RepetitionTracker(self.history)
+            if repetition.repeated():
+                no_act = list(repetition.previous_moves())
             action, value, depth = self.player.close_and_return_action(self.state, self.turns, no_act)
             self.player = None
+            # the search was interrupted, do not reuse its half-updated tree
+            self.search_tree = SearchTree(self.config.play.max_tree_nodes)
             self.model.close_pipes()
             self.info_best_move(action, value, depth)
         else:
@@ -278,18 +279,15 @@ class UCI:
         no_act = None
         _, _, _, check = senv.done(self.state, need_check=True)
         logger.debug(f"Check = {check}, state = {self.state}")
-        if not check and self.state in self.history[:-1]:
-            no_act = []
-            for i in range(len(self.history) - 1):
-                if self.history[i] == self.state:
-                    if senv.will_check_or_catch(self.state, self.history[i+1]):
-                        no_act.append(self.history[i + 1])
-                        logger.debug(f"Foul: no act = {no_act}")
+        repetition = senv.RepetitionTracker(self.history)
+        if not check and repetition.repeated():
+            no_act = [move for move, verdict in repetition.verdicts(self.state) if verdict < 0]
+            logger.debug(f"Foul: no act = {no_act}")
         action, _ = self.player.action(self.state, self.turns, no_act=no_act, depth=depth, 
                                         infinite=infinite, hist=self.history)
         if self.t:
             self.t.cancel()
-        _, value = self.player.debug[self.state]
+        _, value = self.player.debug[senv.state_key(self.state)]
         depth = self.player.done_tasks // 100
         self.player.close(wait=False)
         self.player = None
@@ -307,15 +305,12 @@ class UCI:
         logger.debug(f"info depth {depth} score {score} time {int((self.end_time - self.start_time) * 1000)}")
         sys.stdout.flush()
         # get ponder
-        state = senv.step(self.state, action)
+        key = senv.state_key(senv.step(self.state, action))
         ponder = None
-        if state in self.search_tree:
-            node = self.search_tree[state]
-            cnt = 0
-            for mov, action_state in node.a.items():
-                if action_state.n > cnt:
-                    ponder = mov
-                    cnt = action_state.n
+        if key in self.search_tree:
+            node = self.search_tree[key]
+            if node.a_n is not None and len(node.a_n) > 0 and node.a_n.max() > 0:
+                ponder = node.legal_moves[int(np.argmax(node.a_n))]
         if not self.is_red_turn:
             action = flip_move(action)
         action = senv.to_uci_move(action)
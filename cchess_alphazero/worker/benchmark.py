@@ -0,0 +1,144 @@
+'''
+MCTS throughput benchmark without a neural network: CChessPlayer searches the perft reference
+positions against a stub model served by the real CChessModelAPI, for every combination of
+search_threads, virtual_loss and batched_search, and reports simulations and new nodes per
+second, the mean prediction batch size and the time spent in selection, expansion (input
+planes of the new leaves) and backup. With threads these times are summed over all threads.
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import product
+from threading import Lock
+from time import time, sleep
+
+import numpy as np
+
+import cchess_alphazero.environment.static_env as senv
+from cchess_alphazero.agent.api import CChessModelAPI
+from cchess_alphazero.agent.player import CChessPlayer
+from cchess_alphazero.config import Config
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed
+from cchess_alphazero.environment.perft import Perft_Positions, fen_to_state
+
+Search_Threads = [8, 16, 32, 64]
+Virtual_Losses = [1, 3]
+Batched_Search = [False, True]
+
+class StubNetwork:
+    '''
+    Stands in for the Keras model: uniform or random priors and values after `latency_ms`
+    plus `latency_us_per_state` for each state of the batch
+    '''
+    def __init__(self, input_shape, n_labels, prior='random', latency_ms=0, latency_us_per_state=0):
+        self.input_shape = (None,) + tuple(input_shape)
+        self.n_labels = n_labels
+        self.prior = prior
+        self.latency = latency_ms / 1000
+        self.latency_per_state = latency_us_per_state / 1e6
+        self.rng = np.random.RandomState(0)
+
+    def predict_on_batch(self, data):
+        n = len(data)
+        if self.latency or self.latency_per_state:
+            sleep(self.latency + self.latency_per_state * n)
+        if self.prior == 'uniform':
+            return np.full((n, self.n_labels), 1 / self.n_labels, dtype=np.float32), np.zeros((n, 1), dtype=np.float32)
+        policy = self.rng.random_sample((n, self.n_labels)).astype(np.float32)
+        policy /= policy.sum(axis=1, keepdims=True)
+        return policy, self.rng.uniform(-1, 1, (n, 1)).astype(np.float32)
+
+class StubModel:
+    '''
+    The parts of CChessModel used by CChessModelAPI
+    '''
+    def __init__(self, network):
+        self.model = network
+        self.n_labels = network.n_labels
+        self.digest = 'stub'
+        self.graph = self
+
+    @contextmanager
+    def as_default(self):
+        yield
+
+class TimedPlayer(CChessPlayer):
+    '''
+    CChessPlayer which accumulates the time of each search phase in `timers`
+    '''
+    def __init__(self, *args, **kwargs):
+        self.timers = defaultdict(float)
+        self.timer_lock = Lock()
+        super().__init__(*args, **kwargs)
+
+    def add_time(self, phase, start):
+        with self.timer_lock:
+            self.timers[phase] += time() - start
+
+    def select_action_q_and_u(self, key, is_root_node):
+        start = time()
+        ret = super().select_action_q_and_u(key, is_root_node)
+        self.add_time('selection', start)
+        return ret
+
+    def encode(self, pos, history, real_hist=None):
+        start = time()
+        ret = super().encode(pos, history, real_hist)
+        self.add_time('expansion', start)
+        return ret
+
+    def backup(self, v, history):
+        start = time()
+        super().backup(v, history)
+        self.add_time('backup', start)
+
+    def update_tree(self, p, v, history):
+        start = time()
+        super().update_tree(p, v, history)
+        self.add_time('backup', start)
+
+def run(config: Config, api, pipe, states):
+    '''
+    Search each state once with a new player, return (simulations, new nodes, seconds,
+    prediction batches, states predicted, phase timers)
+    '''
+    n_batches, n_states = api.n_batches, api.n_states
+    sims = nodes = 0
+    timers = defaultdict(float)
+    start = time()
+    for state in states:
+        player = TimedPlayer(config, pipes=pipe)
+        player.action(state, 0)
+        sims += player.done_tasks
+        nodes += len(player.tree)
+        for phase, seconds in player.timers.items():
+            timers[phase] += seconds
+        player.close()
+    return sims, nodes, time() - start, api.n_batches - n_batches, api.n_states - n_states, timers
+
+def start(config: Config, prior='random', latency_ms=0):
+    pc = config.play
+    saved = pc.search_threads, pc.virtual_loss, pc.batched_search
+    states = [fen_to_state(fen) for _, fen, _ in Perft_Positions]
+    network = StubNetwork(senv.array_to_planes(senv.Position(states[0]).board).shape, len(ActionLabelsRed),
+                          prior, latency_ms)
+    api = CChessModelAPI(config, StubModel(network))
+    api.start(need_reload=False)
+    pipes = []      # kept open until the end, the API logs an error for a closed pipe
+    print(f"{len(states)} positions, {pc.simulation_num_per_move} simulations per move, "
+          f"{prior} priors, {latency_ms} ms latency per batch")
+    print(f"{'threads':>7} {'vloss':>5} {'batched':>7} {'sims/s':>8} {'nodes/s':>8} {'batch':>6} "
+          f"{'select':>7} {'expand':>7} {'backup':>7} {'total':>7}")
+    try:
+        for threads, virtual_loss, batched in product(Search_Threads, Virtual_Losses, Batched_Search):
+            pc.search_threads, pc.virtual_loss, pc.batched_search = threads, virtual_loss, batched
+            # a new pipe for each setting, the shared memory slots depend on search_threads
+            pipes.append(api.get_pipe(need_reload=False))
+            sims, nodes, seconds, n_batches, n_states, timers = run(config, api, pipes[-1], states)
+            print(f"{threads:>7} {virtual_loss:>5} {str(batched):>7} {sims / seconds:>8.0f} {nodes / seconds:>8.0f} "
+                  f"{n_states / max(n_batches, 1):>6.1f} {timers['selection']:>6.2f}s {timers['expansion']:>6.2f}s "
+                  f"{timers['backup']:>6.2f}s {seconds:>6.2f}s")
+    finally:
+        pc.search_threads, pc.virtual_loss, pc.batched_search = saved
+        api.close()
+        # let the prediction worker stop before the pipes are closed
+        sleep(0.01)
@@ -17,7 +17,7 @@ import subprocess
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, SearchTree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
@@ -139,8 +139,8 @@ class EvaluateWorker:
 
         pipe1 = self.pipes_bt.pop()
         pipe2 = self.pipes_ng.pop()
-        search_tree1 = defaultdict(VisitState)
-        search_tree2 = defaultdict(VisitState)
+        search_tree1 = SearchTree(self.config.play.max_tree_nodes)
+        search_tree2 = SearchTree(self.config.play.max_tree_nodes)
 
         self.player1 = CChessPlayer(self.config, search_tree=search_tree1, pipes=pipe1, 
                         debugging=False, enable_resign=False, use_history=self.hist_base)
@@ -14,7 +14,7 @@ import numpy as np
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, SearchTree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
@@ -147,8 +147,8 @@ class EvaluateWorker:
     def start_game(self, idx):
         pipe1 = self.pipes_bt.pop()
         pipe2 = self.pipes_ng.pop()
-        search_tree1 = defaultdict(VisitState)
-        search_tree2 = defaultdict(VisitState)
+        search_tree1 = SearchTree(self.config.play.max_tree_nodes)
+        search_tree2 = SearchTree(self.config.play.max_tree_nodes)
 
         playouts = randint(8, 12) * 100
         self.config.play.simulation_num_per_move = playouts
@@ -6,6 +6,7 @@ import shutil
 import numpy as np
 
 from collections import deque
+from queue import Queue
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from logging import getLogger
@@ -16,11 +17,12 @@ from threading import Thread
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
 from cchess_alphazero.config import Config
-from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
+from cchess_alphazero.lib.data_helper import GameManifest, read_game_data_from_file, split_games
+from cchess_alphazero.lib.replay_buffer import ReplayBuffer, sparse_batches
 from cchess_alphazero.lib.model_helper import load_best_model_weight, save_as_best_model
 from cchess_alphazero.lib.model_helper import need_to_reload_best_model_weight, save_as_next_generation_model, save_as_best_model
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, Move_2_Idx, Mirrored_index, flip_policy, flip_move, densify_policy
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import http_request
 
@@ -41,15 +43,24 @@ class OptimizeWorker:
         self.model = None
         self.loaded_filenames = set()
         self.loaded_data = deque(maxlen=self.config.trainer.dataset_size)
-        self.dataset = deque(), deque(), deque()
+        self.dataset = deque(), deque(), deque(), deque()    # planes, policy labels, policy probabilities, values
         self.executor = ProcessPoolExecutor(max_workers=config.trainer.cleaning_processes)
         self.filenames = []
         self.opt = None
         self.count = 0
         self.eva = False
+        self.replay_buffer = None
+        self.new_positions = 0  # positions added to the replay buffer since the last training
+        self.policy_k = max(config.trainer.policy_k, 1)    # policy targets per position
+        self.manifest = None
 
     def start(self):
         self.model = self.load_model()
+        self.manifest = GameManifest(self.config.resource, self.config.play_data.manifest_sync_interval)
+        tc = self.config.trainer
+        if tc.use_replay_buffer:
+            self.replay_buffer = ReplayBuffer(self.config.resource.replay_buffer_dir, tc.dataset_size,
+                                              self.config.opts.has_history, tc.replay_policy_k)
         self.training()
 
     def training(self):
@@ -59,10 +70,10 @@ class OptimizeWorker:
         last_file = None
 
         while True:
-            files = get_game_data_filenames(self.config.resource)
-            offset = self.config.trainer.min_games_to_begin_learn
-            if (len(files) < self.config.trainer.min_games_to_begin_learn \
-              or ((last_file is not None and last_file in files) and files.index(last_file) + 1 + offset > len(files))):
+            self.manifest.refresh()
+            # files added after the last trained one
+            files = self.manifest.filenames(after=last_file)
+            if len(files) < self.config.trainer.min_games_to_begin_learn:
                 # if last_file is not None:
                 #     logger.info('Waiting for enough data 300s, ' + str((len(files) - files.index(last_file)) * self.config.play_data.nb_game_in_file) \
                 #             +' vs '+ str(self.config.trainer.min_games_to_begin_learn)+' games')
@@ -74,58 +85,91 @@ class OptimizeWorker:
                     self.save_current_model(send=True)
                 break
             else:
-                if last_file is not None and last_file in files:
-                    idx = files.index(last_file) + 1
-                    if len(files) - idx > self.config.trainer.load_step:
-                        files = files[idx:idx + self.config.trainer.load_step]
-                    else:
-                        files = files[idx:]
-                elif len(files) > self.config.trainer.load_step:
-                    files = files[0:self.config.trainer.load_step]
+                files = files[0:self.config.trainer.load_step]
                 last_file = files[-1]
-                logger.info(f"Last file = {last_file}")
+                logger.info(f"Last file = {last_file}, play_data has {len(self.manifest)} files, "
+                            f"{self.manifest.n_games()} games, {self.manifest.n_bytes / 1024 / 1024:.1f} MB")
                 logger.debug(f"files = {files[0:-1:2000]}")
+                if self.config.trainer.streaming:
+                    self.update_learning_rate(total_steps)
+                    steps = self.train_stream(list(files), self.config.trainer.epoch_to_checkpoint)
+                    if steps:
+                        total_steps += steps
+                        self.save_current_model(send=False)
+                        self.update_learning_rate(total_steps)
+                        self.count += 1
+                        self.backup_play_data(files)
+                    continue
                 self.filenames = deque(files)
                 logger.debug(f"Start training {len(self.filenames)} files")
                 shuffle(self.filenames)
                 self.fill_queue()
                 self.update_learning_rate(total_steps)
-                if len(self.dataset[0]) > self.config.trainer.batch_size:
+                loaded = self.new_positions if self.replay_buffer is not None else len(self.dataset[0])
+                if loaded > self.config.trainer.batch_size:
                     steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
                     total_steps += steps
                     self.save_current_model(send=False)
                     self.update_learning_rate(total_steps)
                     self.count += 1
-                    a, b, c = self.dataset
-                    a.clear()
-                    b.clear()
-                    c.clear()
-                    del self.dataset, a, b, c
+                    for x in self.dataset:
+                        x.clear()
+                    del self.dataset, x
                     gc.collect()
-                    self.dataset = deque(), deque(), deque()
+                    self.dataset = deque(), deque(), deque(), deque()
+                    if self.replay_buffer is not None:
+                        self.replay_buffer.flush()
+                        self.new_positions = 0
                     self.backup_play_data(files)
 
     def train_epoch(self, epochs):
         tc = self.config.trainer
-        state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
+        if self.replay_buffer is not None:
+            # as many samples per epoch as newly loaded positions, drawn from the whole buffer
+            steps_per_epoch = max(self.new_positions // tc.batch_size, 1)
+            model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+            model.fit_generator(self.replay_buffer.generator(tc.batch_size),
+                                steps_per_epoch=steps_per_epoch,
+                                epochs=epochs,
+                                callbacks=[TensorBoard(log_dir="./logs", batch_size=tc.batch_size)])
+            return steps_per_epoch * epochs
+        state_ary, policy_idx, policy_p, value_ary = self.collect_all_loaded_data()
         tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
-        if self.config.opts.use_multiple_gpus:
-            self.mg_model.fit(state_ary, [policy_ary, value_ary],
-                                 batch_size=tc.batch_size,
-                                 epochs=epochs,
-                                 shuffle=True,
-                                 validation_split=0.02,
-                                 callbacks=[tensorboard_cb])
-        else:
-            self.model.model.fit(state_ary, [policy_ary, value_ary],
-                                 batch_size=tc.batch_size,
-                                 epochs=epochs,
-                                 shuffle=True,
-                                 validation_split=0.02,
-                                 callbacks=[tensorboard_cb])
+        # the last 2% are the validation data, like validation_split
+        split = len(state_ary) - int(len(state_ary) * 0.02)
+        validation_data = (state_ary[split:], [densify_policy(policy_idx[split:], policy_p[split:]), value_ary[split:]])
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        model.fit_generator(sparse_batches(state_ary[:split], policy_idx[:split], policy_p[:split], value_ary[:split],
+                                           tc.batch_size),
+                            steps_per_epoch=(split + tc.batch_size - 1) // tc.batch_size,
+                            epochs=epochs,
+                            validation_data=validation_data,
+                            callbacks=[tensorboard_cb])
         steps = (state_ary.shape[0] // tc.batch_size) * epochs
         return steps
 
+    def train_stream(self, files, epochs):
+        '''
+        Train on batches streamed from the files while worker processes keep decoding the next ones
+        '''
+        tc = self.config.trainer
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        steps = 0
+        for epoch in range(epochs):
+            shuffle(files)
+            stream = TrainingStream(self.executor, files, tc.batch_size, self.config.opts.has_history,
+                                    tc.mirror_augment, tc.stream_shuffle_size, tc.stream_prefetch,
+                                    tc.cleaning_processes * 2, self.policy_k)
+            losses = []
+            for x, y in stream:
+                losses.append(model.train_on_batch(x, y))
+                steps += 1
+                if len(losses) == 100:
+                    logger.debug(f"Epoch {epoch + 1}/{epochs}, step {steps}, loss = {np.mean(losses, axis=0)}")
+                    losses = []
+            self.remove_missing_files(stream.failed)
+        return steps
+
     def compile_model(self):
         self.opt = SGD(lr=0.02, momentum=self.config.trainer.momentum)
         losses = ['categorical_crossentropy', 'mean_squared_error']
@@ -149,16 +193,25 @@ class OptimizeWorker:
     def fill_queue(self):
         futures = deque()
         n = len(self.filenames)
+        load = load_data_from_file if self.replay_buffer is None else load_compact_data_from_file
         with ProcessPoolExecutor(max_workers=self.config.trainer.cleaning_processes) as executor:
             for _ in range(self.config.trainer.cleaning_processes):
                 if len(self.filenames) == 0:
                     break
                 filename = self.filenames.pop()
                 # logger.debug("loading data from %s" % (filename))
-                futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
-            while futures and len(self.dataset[0]) < self.config.trainer.dataset_size: #fill tuples
-                _tuple = futures.popleft().result()
-                if _tuple is not None:
+                futures.append((filename, executor.submit(load, filename, self.config.opts.has_history,
+                                                          self.config.trainer.mirror_augment, self.policy_k)))
+            while futures and (self.replay_buffer is not None or \
+                               len(self.dataset[0]) < self.config.trainer.dataset_size): #fill tuples
+                filename, future = futures.popleft()
+                _tuple = future.result()
+                if _tuple is None:
+                    self.remove_missing_files([filename])
+                elif self.replay_buffer is not None:
+                    self.replay_buffer.add(*_tuple)
+                    self.new_positions += len(_tuple[-1])
+                else:
                     for x, y in zip(self.dataset, _tuple):
                         x.extend(y)
                 m = len(self.filenames)
@@ -167,15 +220,26 @@ class OptimizeWorker:
                         logger.info(f"Reading {n - m} files")
                     filename = self.filenames.pop()
                     # logger.debug("loading data from %s" % (filename))
-                    futures.append(executor.submit(load_data_from_file, filename, self.config.opts.has_history))
+                    futures.append((filename, executor.submit(load, filename, self.config.opts.has_history,
+                                                              self.config.trainer.mirror_augment, self.policy_k)))
+
+    def remove_missing_files(self, files):
+        '''
+        Drop the files which are gone (deleted by another worker or as broken) from the manifest
+        '''
+        missing = [filename for filename in files if not os.path.exists(filename)]
+        if missing:
+            logger.info(f"Skip {len(missing)} missing files")
+            self.manifest.remove(missing)
 
     def collect_all_loaded_data(self):
-        state_ary, policy_ary, value_ary = self.dataset
+        state_ary, policy_idx, policy_p, value_ary = self.dataset
 
         state_ary1 = np.asarray(state_ary, dtype=np.float32)
-        policy_ary1 = np.asarray(policy_ary, dtype=np.float32)
+        policy_idx1 = np.asarray(policy_idx, dtype=np.int16)
+        policy_p1 = np.asarray(policy_p, dtype=np.float32)
         value_ary1 = np.asarray(value_ary, dtype=np.float32)
-        return state_ary1, policy_ary1, value_ary1
+        return state_ary1, policy_idx1, policy_p1, value_ary1
 
     def load_model(self):
         model = CChessModel(self.config)
@@ -218,78 +282,210 @@ class OptimizeWorker:
             except Exception as e:
                 # logger.error(f"Backup error : {e}")
                 cnt = cnt + 1
+        self.manifest.remove(files)
         logger.info(f"backup {len(files)} files, {cnt} empty files")
 
-def load_data_from_file(filename, use_history=False):
+class TrainingStream:
+    '''
+    Streaming input of the optimizer: files are decoded and encoded by the worker processes of
+    `executor` (`jobs` files in flight), positions are shuffled in a pool of about `shuffle_size` and dense mini-batches
+    are prefetched in a queue of `prefetch` batches by a background thread. Iterate to get
+    (planes, [policy, value]) until the files are exhausted
+    '''
+    def __init__(self, executor, filenames, batch_size, use_history=False, mirror=False,
+                 shuffle_size=20000, prefetch=8, jobs=2, policy_k=1):
+        self.executor = executor
+        self.policy_k = policy_k
+        self.jobs = jobs
+        self.filenames = deque(filenames)
+        self.failed = []    # files which could not be loaded
+        self.batch_size = batch_size
+        self.use_history = use_history
+        self.mirror = mirror
+        self.shuffle_size = shuffle_size
+        self.queue = Queue(maxsize=prefetch)
+        producer = Thread(target=self.producer, name="stream_producer")
+        producer.daemon = True
+        producer.start()
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            yield batch
+
+    def producer(self):
+        futures = deque()
+        pool = None
+        try:
+            while self.filenames or futures:
+                while self.filenames and len(futures) < self.jobs:
+                    filename = self.filenames.popleft()
+                    futures.append((filename, self.executor.submit(load_data_from_file, filename, self.use_history,
+                                                                   self.mirror, self.policy_k)))
+                filename, future = futures.popleft()
+                _tuple = future.result()
+                if _tuple is None:
+                    self.failed.append(filename)
+                    continue
+                pool = _tuple if pool is None else tuple(np.concatenate(x) for x in zip(pool, _tuple))
+                if len(pool[0]) >= self.shuffle_size:
+                    # emit half of the shuffled pool, the rest is mixed with the next files
+                    pool = self.put_batches(pool, len(pool[0]) // 2)
+            if pool is not None:
+                self.put_batches(pool, len(pool[0]), last=True)
+        except Exception as e:
+            logger.error(f"Training stream error: {e}")
+        self.queue.put(None)
+
+    def put_batches(self, pool, n, last=False):
+        '''
+        Shuffle the pool, send the batches of its first n positions and return the rest
+        (the last call also sends a final partial batch)
+        '''
+        order = np.random.permutation(len(pool[0]))
+        pool = tuple(x[order] for x in pool)
+        if not last:
+            n -= n % self.batch_size
+        for i in range(0, n, self.batch_size):
+            state_ary, policy_idx, policy_p, value_ary = (x[i:i + self.batch_size] for x in pool)
+            self.queue.put((state_ary, [densify_policy(policy_idx, policy_p), value_ary]))
+        return tuple(x[n:] for x in pool)
+
+def read_games(filename, expand, use_history=False, mirror=False, policy_k=1):
+    '''
+    Read the games of a file and expand each of them with `expand`, return the non empty
+    results or None. A file which can not be read is deleted
+    '''
     try:
         data = read_game_data_from_file(filename)
     except Exception as e:
         logger.error(f"Error when loading data {e}")
-        os.remove(filename)
+        try:
+            os.remove(filename)
+        except OSError:     # already gone
+            pass
         return None
     if data is None:
         return None
-    return expanding_data(data, use_history)
+    games = [expand(game, use_history, mirror, policy_k) for game in split_games(data)]
+    return [game for game in games if game is not None] or None
 
-def expanding_data(data, use_history=False):
+def load_data_from_file(filename, use_history=False, mirror=False, policy_k=1):
+    games = read_games(filename, expanding_data, use_history, mirror, policy_k)
+    if games is None:
+        return None
+    return tuple(np.concatenate(ary) for ary in zip(*games))
+
+def load_compact_data_from_file(filename, use_history=False, mirror=False, policy_k=1):
+    '''
+    Same as load_data_from_file, but positions are returned in the compact form of ReplayBuffer.add
+    '''
+    games = read_games(filename, expanding_compact_data, use_history, mirror, policy_k)
+    if games is None:
+        return None
+    boards, last_boards, policy_idx, policy_p, values = zip(*games)
+    return np.concatenate(boards), np.concatenate(last_boards) if use_history else None, \
+           np.concatenate(policy_idx), np.concatenate(policy_p), np.concatenate(values)
+
+def expanding_compact_data(data, use_history=False, mirror=False, policy_k=1):
+    '''
+    Replay a game on a compact board: boards (N x 90), boards two plies back (or None),
+    policy as (label, probability) pairs and values
+    '''
+    pos = senv.Position(data[0])
+    boards, values = [], []
+    try:
+        for item in data[1:]:
+            boards.append(bytes(pos.board))
+            values.append(item[1])
+            pos.make_move(item[0])
+        policy_idx, policy_p = build_sparse_policy(data[1:], policy_k)
+    except Exception as e:
+        logger.error(f"Expand data error {e}, item = {item}, data = {data}")
+        return None
+    boards = np.frombuffer(b''.join(boards), dtype=np.uint8).reshape(-1, 90)
+    values = np.asarray(values, dtype=np.float32)
+    last_boards = None
+    if use_history:
+        last_boards = np.zeros_like(boards)
+        last_boards[2:] = boards[:-2]
+    if mirror:
+        boards = np.concatenate((boards, senv.mirror_arrays(boards)))
+        if use_history:
+            last_boards = np.concatenate((last_boards, senv.mirror_arrays(last_boards)))
+        policy_idx = np.concatenate((policy_idx, np.asarray(Mirrored_index, dtype=np.int16)[policy_idx]))
+        policy_p = np.concatenate((policy_p, policy_p))
+        values = np.concatenate((values, values))
+    return boards, last_boards, policy_idx, policy_p, values
+
+def expanding_data(data, use_history=False, mirror=False, policy_k=1):
     state = data[0]
     real_data = []
     action = None
-    policy = None
     value = None
     if use_history:
         history = [state]
     else:
         history = None
+    try:
+        policy_idx, policy_p = build_sparse_policy(data[1:], policy_k)
+    except Exception as e:
+        logger.error(f"Expand data error {e}, data = {data}")
+        return None
     for item in data[1:]:
         action = item[0]
         value = item[1]
-        try:
-            policy = build_policy(action, flip=False)
-        except Exception as e:
-            logger.error(f"Expand data error {e}, item = {item}, data = {data}, state = {state}")
-            return None
-        real_data.append([state, policy, value])
+        real_data.append([state, value])
         state = senv.step(state, action)
         if use_history:
             history.append(action)
             history.append(state)
         
-    return convert_to_trainging_data(real_data, history)
-
+    return convert_to_trainging_data(real_data, policy_idx, policy_p, history, mirror)
 
-def convert_to_trainging_data(data, history):
-    state_list = []
-    policy_list = []
-    value_list = []
-    i = 0
 
-    for state, policy, value in data:
-        if history is None:
-            state_planes = senv.state_to_planes(state)
+def convert_to_trainging_data(data, policy_idx, policy_p, history, mirror=False):
+    '''
+    Return planes, policy targets as labels and probabilities (densified per batch) and values
+    '''
+    states = [state for state, _ in data]
+    if history is None:
+        state_ary = senv.states_to_planes(states)
+    else:
+        # history = [state, action, state, ...], the planes also encode the state two plies back
+        state_ary = senv.states_to_planes(states, [history[i * 2 - 4] if i >= 2 else None for i in range(len(data))])
+    value_ary = np.asarray([value for _, value in data], dtype=np.float32)
+    if mirror:
+        # left-right mirrored positions double the data
+        state_ary = np.concatenate((state_ary, senv.mirror_planes(state_ary)))
+        policy_idx = np.concatenate((policy_idx, np.asarray(Mirrored_index, dtype=np.int16)[policy_idx]))
+        policy_p = np.concatenate((policy_p, policy_p))
+        value_ary = np.concatenate((value_ary, value_ary))
+    return state_ary, policy_idx, policy_p, value_ary
+
+def build_sparse_policy(items, policy_k=1):
+    '''
+    Policy targets of the moves of a game as N x policy_k labels and probabilities: the visit
+    counts of the search ([move, value, [[label, visits], ...]], the policy_k most visited moves)
+    or the played move if they were not stored
+    '''
+    policy_idx = np.zeros((len(items), policy_k), dtype=np.int16)
+    policy_p = np.zeros((len(items), policy_k), dtype=np.float32)
+    for i, item in enumerate(items):
+        visits = sorted(item[2], key=lambda x: -x[1])[:policy_k] if len(item) > 2 else None
+        total = sum(n for _, n in visits) if visits else 0
+        if total > 0:
+            for j, (label, n) in enumerate(visits):
+                policy_idx[i, j] = label
+                policy_p[i, j] = n / total
         else:
-            state_planes = senv.state_history_to_planes(state, history[0:i * 2 + 1])
-        sl_value = value
-
-        state_list.append(state_planes)
-        policy_list.append(policy)
-        value_list.append(sl_value)
-        i += 1
-
-    return np.asarray(state_list, dtype=np.float32), \
-           np.asarray(policy_list, dtype=np.float32), \
-           np.asarray(value_list, dtype=np.float32)
-
-def build_policy(action, flip):
-    labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
-    policy = np.zeros(labels_n)
-
-    policy[move_lookup[action]] = 1
+            policy_idx[i, 0] = build_policy_label(item[0], flip=False)
+            policy_p[i, 0] = 1
+    return policy_idx, policy_p
 
+def build_policy_label(action, flip):
     if flip:
-        policy = flip_policy(policy)
-    return list(policy)
-
-
-
+        action = flip_move(action)
+    return Move_2_Idx[action]
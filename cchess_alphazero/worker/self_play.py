@@ -8,18 +8,17 @@ from datetime import datetime, timezone, timedelta
 from logging import getLogger
 from multiprocessing import Manager
 from time import time, sleep
-from collections import defaultdict
 from random import random
-from threading import Thread
+from threading import Thread, Lock
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
-from cchess_alphazero.agent.api import CChessModelAPI
+from cchess_alphazero.agent.player import CChessPlayer, SearchTree
+from cchess_alphazero.agent.api import CChessModelAPI, SharedPipe
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
-from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, Move_2_Idx, flip_policy, flip_move
+from cchess_alphazero.lib.data_helper import GameManifest, write_game_data_to_file, append_games_to_file, split_games
 from cchess_alphazero.lib.model_helper import load_model_weight, save_as_best_model, load_best_model_weight_from_internet
 from cchess_alphazero.lib.tf_util import set_session_config
 from cchess_alphazero.lib.web_helper import upload_file
@@ -47,6 +46,9 @@ def load_model(config, config_file=None):
 
 def start(config: Config):
     set_session_config(per_process_gpu_memory_fraction=1, allow_growth=True, device_list=config.opts.device_list)
+    if config.play.games_per_process > 1 and not config.play.batched_search:
+        logger.info(f"Play {config.play.games_per_process} games per process, use batched search")
+        config.play.batched_search = True
     current_model, use_history = load_model(config)
     m = Manager()
     cur_pipes = m.list([current_model.get_pipes() for _ in range(config.play.max_processes)])
@@ -68,20 +70,23 @@ class SelfPlayWorker:
         self.buffer = []
         self.pid = os.getpid()
         self.use_history = use_history
+        self.manifest = None    # created in the worker process
 
     def start(self):
         self.pid = os.getpid()
+        self.manifest = GameManifest(self.config.resource, self.config.play_data.manifest_sync_interval)
         ran = self.config.play.max_processes if self.config.play.max_processes > 5 else self.config.play.max_processes * 2
         sleep((self.pid % ran) * 10)
         logger.debug(f"Selfplay#Start Process index = {self.id}, pid = {self.pid}")
+        if self.config.play.games_per_process > 1:
+            return self.start_games(self.config.play.games_per_process)
 
         idx = 1
         self.buffer = []
-        search_tree = defaultdict(VisitState)
+        search_tree = SearchTree(self.config.play.max_tree_nodes)
 
         while True:
             start_time = time()
-            search_tree = defaultdict(VisitState)
             value, turns, state, store = self.start_game(idx, search_tree)
             end_time = time()
             logger.debug(f"Process {self.pid}-{self.id} play game {idx} time={(end_time - start_time):.1f} sec, "
@@ -92,24 +97,63 @@ class SelfPlayWorker:
                 idx += 1
             sleep(random())
 
-    def start_game(self, idx, search_tree):
+    def start_games(self, num_games):
+        '''
+        Play `num_games` games at the same time in threads of this process, the leaves
+        of all games are sent to the model in one batch through a SharedPipe
+        '''
         pipes = self.cur_pipes.pop()
+        shared = SharedPipe(pipes, num_games)
+        self.buffer = []
+        self.idx = 0
+        self.lock = Lock()
+        workers = []
+        for i in range(num_games):
+            worker = Thread(target=self.play_games, args=(shared.get_pipe(),), name=f"game_worker_{i}")
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+    def play_games(self, pipes):
+        try:
+            while True:
+                start_time = time()
+                search_tree = SearchTree(self.config.play.max_tree_nodes)
+                value, turns, state, store = self.start_game(None, search_tree, pipes)
+                end_time = time()
+                logger.debug(f"Process {self.pid}-{self.id} play game {self.idx} time={(end_time - start_time):.1f} sec, "
+                             f"turn={turns / 2}, winner = {value:.2f} (1 = red, -1 = black, 0 draw)")
+        finally:
+            # the other games of the process stop waiting for this one
+            pipes.detach()
 
-        if not self.config.play.share_mtcs_info_in_self_play or \
-            idx % self.config.play.reset_mtcs_info_per_game == 0:
-            search_tree = defaultdict(VisitState)
+    def start_game(self, idx, search_tree, pipes=None):
+        '''
+        Play one game, `idx` is None if several games are played at the same time
+        '''
+        shared_pipes = pipes is not None
+        if not shared_pipes:
+            pipes = self.cur_pipes.pop()
+
+        share_tree = self.config.play.share_mtcs_info_in_self_play and idx is not None
+        if not share_tree or idx % self.config.play.reset_mtcs_info_per_game == 0:
+            search_tree.clear()
 
         if random() > self.config.play.enable_resign_rate:
             enable_resign = True
         else:
             enable_resign = False
 
-        self.player = CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, 
+        player = CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, 
                                     enable_resign=enable_resign, debugging=False, use_history=self.use_history)
 
         state = senv.INIT_STATE
         history = [state]
-        # policys = [] 
+        repetition = senv.RepetitionTracker(history)
+        visits = []     # visit counts of the search for each move
+        top_k = self.config.play_data.visit_top_k
         value = 0
         turns = 0       # even == red; odd == black
         game_over = False
@@ -121,7 +165,7 @@ class SelfPlayWorker:
 
         while not game_over:
             start_time = time()
-            action, policy = self.player.action(state, turns, no_act, increase_temp=increase_temp)
+            action, policy = player.action(state, turns, no_act, increase_temp=increase_temp)
             end_time = time()
             if action is None:
                 logger.debug(f"{turns % 2} (0 = red; 1 = black) has resigned!")
@@ -131,7 +175,8 @@ class SelfPlayWorker:
             #     logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
             # logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
             history.append(action)
-            # policys.append(policy)
+            repetition.play(action)
+            visits.append(player.visit_counts(state, no_act, top_k) if top_k else None)
             try:
                 state, no_eat = senv.new_step(state, action)
             except Exception as e:
@@ -139,12 +184,17 @@ class SelfPlayWorker:
                 game_over = True
                 value = 0
                 break
+            if not share_tree:
+                # a shared tree keeps the other positions for the next games, it is only
+                # pruned when it goes over max_tree_nodes
+                player.advance_root(state)
             turns += 1
             if no_eat:
                 no_eat_count += 1
             else:
                 no_eat_count = 0
             history.append(state)
+            repetition.push(senv.state_key(state))
 
             if no_eat_count >= 120 or turns / 2 >= self.config.play.max_game_length:
                 game_over = True
@@ -158,34 +208,33 @@ class SelfPlayWorker:
                         value = 0
                 increase_temp = False
                 no_act = []
-                if not game_over and not check and state in history[:-1]:
-                    free_move = defaultdict(int)
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            if senv.will_check_or_catch(state, history[i+1]):
-                                no_act.append(history[i + 1])
-                            elif not senv.be_catched(state, history[i+1]):
-                                increase_temp = True
-                                free_move[state] += 1
-                                if free_move[state] >= 3:
-                                    # 作和棋处理
-                                    game_over = True
-                                    value = 0
-                                    logger.info("闲着循环三次，作和棋处理")
-                                    break
+                if not game_over and not check and repetition.repeated():
+                    free_move = 0
+                    for move, verdict in repetition.verdicts(state):
+                        if verdict < 0:
+                            no_act.append(move)
+                        elif verdict == 0:
+                            increase_temp = True
+                            free_move += 1
+                            if free_move >= 3:
+                                # 作和棋处理
+                                game_over = True
+                                value = 0
+                                logger.info("闲着循环三次，作和棋处理")
+                                break
 
         if final_move:
             # policy = self.build_policy(final_move, False)
             history.append(final_move)
-            # policys.append(policy)
+            visits.append(None)
             state = senv.step(state, final_move)
             turns += 1
             value = -value
             history.append(state)
 
-        self.player.close()
+        player.close()
         del search_tree
-        del self.player
+        del player
         gc.collect()
         if turns % 2 == 1:  # balck turn
             value = -value
@@ -203,16 +252,29 @@ class SelfPlayWorker:
             data = [history[0]]
             for i in range(turns):
                 k = i * 2
-                data.append([history[k + 1], value])
+                if visits[i]:
+                    data.append([history[k + 1], value, visits[i]])
+                else:
+                    data.append([history[k + 1], value])
                 value = -value
-            self.save_play_data(idx, data)
+            if idx is None:
+                with self.lock:
+                    self.idx += 1
+                    self.save_play_data(self.idx, data)
+            else:
+                self.save_play_data(idx, data)
 
-        self.cur_pipes.append(pipes)
+        if not shared_pipes:
+            self.cur_pipes.append(pipes)
         self.remove_play_data()
         return v, turns, state, store
 
     def save_play_data(self, idx, data):
-        self.buffer += data
+        binary = self.config.play_data.binary_format
+        if binary:
+            self.buffer.append(data)
+        else:
+            self.buffer += data
 
         if not idx % self.config.play_data.nb_game_in_file == 0:
             return
@@ -221,10 +283,18 @@ class SelfPlayWorker:
         utc_dt = datetime.utcnow().replace(tzinfo=timezone.utc)
         bj_dt = utc_dt.astimezone(timezone(timedelta(hours=8)))
         game_id = bj_dt.strftime("%Y%m%d-%H%M%S.%f")
-        filename = rc.play_data_filename_tmpl % game_id
+        if binary:
+            filename = rc.play_data_bin_filename_tmpl % game_id
+        else:
+            filename = rc.play_data_filename_tmpl % game_id
         path = os.path.join(rc.play_data_dir, filename)
         logger.info(f"Process {self.pid} save play data to {path}")
-        write_game_data_to_file(path, self.buffer)
+        if binary:
+            append_games_to_file(path, self.buffer)
+            self.manifest.add(path, len(self.buffer))
+        else:
+            write_game_data_to_file(path, self.buffer)
+            self.manifest.add(path, len(split_games(self.buffer)))
         if self.config.internet.distributed:
             upload_worker = Thread(target=self.upload_play_data, args=(path, filename), name="upload_worker")
             upload_worker.daemon = True
@@ -241,21 +311,13 @@ class SelfPlayWorker:
             logger.error(f'Upload play data {filename} failed. {response.msg if response is not None else None}')
 
     def remove_play_data(self):
-        files = get_game_data_filenames(self.config.resource)
-        if len(files) < self.config.play_data.max_file_num:
-            return
-        try:
-            for i in range(len(files) - self.config.play_data.max_file_num):
-                os.remove(files[i])
-        except:
-            pass
+        self.manifest.retain(self.config.play_data.max_file_num, self.config.play_data.max_play_data_mb * 1024 * 1024)
 
     def build_policy(self, action, flip):
         labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
         policy = np.zeros(labels_n)
 
-        policy[move_lookup[action]] = 1
+        policy[Move_2_Idx[action]] = 1
 
         if flip:
             policy = flip_policy(policy)
@@ -15,11 +15,11 @@ from random import random
 
 import cchess_alphazero.environment.static_env as senv
 from cchess_alphazero.agent.model import CChessModel
-from cchess_alphazero.agent.player import CChessPlayer, VisitState
+from cchess_alphazero.agent.player import CChessPlayer, SearchTree
 from cchess_alphazero.agent.api import CChessModelAPI
 from cchess_alphazero.config import Config
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import Winner, ActionLabelsRed, Move_2_Idx, flip_policy, flip_move
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
 from cchess_alphazero.lib.model_helper import load_model_weight, save_as_best_model, load_best_model_weight_from_internet
 from cchess_alphazero.lib.tf_util import set_session_config
@@ -162,7 +162,7 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
     else:
         enable_resign = False
 
-    player = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe, 
+    player = CChessPlayer(config, search_tree=SearchTree(config.play.max_tree_nodes), pipes=pipe, 
                             enable_resign=enable_resign, debugging=False, use_history=use_history)
 
     state = senv.INIT_STATE
@@ -195,6 +195,7 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
             game_over = True
             value = 0
             break
+        player.advance_root(state)
         turns += 1
         if no_eat:
             no_eat_count += 1
@@ -258,10 +259,9 @@ def self_play_buffer(config, cur, use_history=False) -> (tuple, list):
 
 def build_policy(action, flip):
     labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
     policy = np.zeros(labels_n)
 
-    policy[move_lookup[action]] = 1
+    policy[Move_2_Idx[action]] = 1
 
     if flip:
         policy = flip_policy(policy)
@@ -15,7 +15,8 @@ from cchess_alphazero.config import Config
 from cchess_alphazero.lib.data_helper import get_game_data_filenames, read_game_data_from_file
 from cchess_alphazero.lib.model_helper import load_sl_best_model_weight, save_as_sl_best_model
 from cchess_alphazero.environment.env import CChessEnv
-from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, flip_policy, flip_move
+from cchess_alphazero.environment.lookup_tables import ActionLabelsRed, Move_2_Idx, flip_policy, flip_move, densify_policy
+from cchess_alphazero.lib.replay_buffer import sparse_batches
 from cchess_alphazero.lib.tf_util import set_session_config
 
 from keras.optimizers import Adam
@@ -33,7 +34,7 @@ class SupervisedWorker:
         self.config = config
         self.model = None
         self.loaded_data = deque(maxlen=self.config.trainer.dataset_size)
-        self.dataset = deque(), deque(), deque()
+        self.dataset = deque(), deque(), deque(), deque()    # planes, policy labels, policy probabilities, values
         self.filenames = []
         self.opt = None
         self.buffer = []
@@ -59,21 +60,22 @@ class SupervisedWorker:
                 steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
                 total_steps += steps
                 self.save_current_model()
-                a, b, c = self.dataset
-                a.clear()
-                b.clear()
-                c.clear()
+                for x in self.dataset:
+                    x.clear()
 
     def train_epoch(self, epochs):
         tc = self.config.trainer
-        state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
+        state_ary, policy_idx, policy_p, value_ary = self.collect_all_loaded_data()
         tensorboard_cb = TensorBoard(log_dir="./logs/tensorboard_sl/", batch_size=tc.batch_size, histogram_freq=1)
-        self.model.model.fit(state_ary, [policy_ary, value_ary],
-                             batch_size=tc.batch_size,
-                             epochs=epochs,
-                             shuffle=True,
-                             validation_split=0.02,
-                             callbacks=[tensorboard_cb])
+        # the last 2% are the validation data, like validation_split
+        split = len(state_ary) - int(len(state_ary) * 0.02)
+        validation_data = (state_ary[split:], [densify_policy(policy_idx[split:], policy_p[split:]), value_ary[split:]])
+        self.model.model.fit_generator(sparse_batches(state_ary[:split], policy_idx[:split], policy_p[:split],
+                                                      value_ary[:split], tc.batch_size),
+                                       steps_per_epoch=(split + tc.batch_size - 1) // tc.batch_size,
+                                       epochs=epochs,
+                                       validation_data=validation_data,
+                                       callbacks=[tensorboard_cb])
         steps = (state_ary.shape[0] // tc.batch_size) * epochs
         return steps
 
@@ -89,12 +91,13 @@ class SupervisedWorker:
                 x.extend(y)
 
     def collect_all_loaded_data(self):
-        state_ary, policy_ary, value_ary = self.dataset
+        state_ary, policy_idx, policy_p, value_ary = self.dataset
 
         state_ary1 = np.asarray(state_ary, dtype=np.float32)
-        policy_ary1 = np.asarray(policy_ary, dtype=np.float32)
+        policy_idx1 = np.asarray(policy_idx, dtype=np.int16)
+        policy_p1 = np.asarray(policy_p, dtype=np.float32)
         value_ary1 = np.asarray(value_ary, dtype=np.float32)
-        return state_ary1, policy_ary1, value_ary1
+        return state_ary1, policy_idx1, policy_p1, value_ary1
 
     def load_model(self):
         model = CChessModel(self.config)
@@ -134,7 +137,7 @@ class SupervisedWorker:
                 wxf_move = red[red.turn == turns]['move'].item()
                 action = env.board.parse_WXF_move(wxf_move)
                 try:
-                    red_moves.append([env.observation, self.build_policy(action, flip=False)])
+                    red_moves.append([env.observation, self.build_policy_label(action, flip=False)])
                 except Exception as e:
                     for i in range(10):
                         logger.debug(f"{env.board.screen[i]}")
@@ -145,7 +148,7 @@ class SupervisedWorker:
                 wxf_move = black[black.turn == turns]['move'].item()
                 action = env.board.parse_WXF_move(wxf_move)
                 try:
-                    black_moves.append([env.observation, self.build_policy(action, flip=True)])
+                    black_moves.append([env.observation, self.build_policy_label(action, flip=True)])
                 except Exception as e:
                     for i in range(10):
                         logger.debug(f"{env.board.screen[i]}")
@@ -175,32 +178,37 @@ class SupervisedWorker:
 
     def build_policy(self, action, flip):
         labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
         policy = np.zeros(labels_n)
 
-        policy[move_lookup[action]] = 1
+        policy[Move_2_Idx[action]] = 1
 
         if flip:
             policy = flip_policy(policy)
         return policy
 
+    def build_policy_label(self, action, flip):
+        # index of the only move of the policy built by build_policy
+        if flip:
+            action = flip_move(action)
+        return Move_2_Idx[action]
+
     def convert_to_trainging_data(self):
         data = self.buffer
         state_list = []
-        policy_list = []
+        label_list = []
         value_list = []
         env = CChessEnv()
 
-        for state_fen, policy, value in data:
+        for state_fen, label, value in data:
             state_planes = env.fen_to_planes(state_fen)
             sl_value = value
 
             state_list.append(state_planes)
-            policy_list.append(policy)
+            label_list.append([label])
             value_list.append(sl_value)
 
-        return np.asarray(state_list, dtype=np.float32), \
-               np.asarray(policy_list, dtype=np.float32), \
+        policy_idx = np.asarray(label_list, dtype=np.int16)
+        return np.asarray(state_list, dtype=np.float32), policy_idx, np.ones(policy_idx.shape, dtype=np.float32), \
                np.asarray(value_list, dtype=np.float32)
 
 